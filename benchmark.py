@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+benchmarks for things which must stay fast. Usage:
+    python benchmark.py startup [--runs=N] [--importtime]
+    python benchmark.py lirc [--runs=N]
+"""
+
+import sys, os, subprocess, time, tempfile, shutil
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def median(values):
+    """the median of values"""
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+def coldStart(statement, runs):
+    """median seconds for executing statement in a fresh interpreter.
+    This runs in an empty directory, so we can check that importing
+    has no side effects like creating halirc.log"""
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(x for x in [HERE, env.get('PYTHONPATH')] if x)
+    times = []
+    try:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', statement], cwd=workdir, env=env)
+            times.append(time.time() - start)
+        if os.listdir(workdir):
+            print 'WARNING: {} created {}'.format(statement, ' '.join(os.listdir(workdir)))
+    finally:
+        shutil.rmtree(workdir)
+    return median(times)
+
+def importTime(module):
+    """show the most expensive imports of module as measured by
+    python -X importtime. Needs python 3.7 or newer"""
+    if sys.version_info < (3, 7):
+        print '-X importtime needs python 3.7 or newer'
+        return
+    env = dict(os.environ)
+    env['PYTHONPATH'] = HERE
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        env=env, stderr=subprocess.PIPE)
+    _, output = process.communicate()
+    lines = [x.split('|') for x in output.decode().split('\n') if x.startswith('import time:')]
+    lines = [(int(x[1]), x[2].rstrip()) for x in lines if x[1].strip().isdigit()]
+    for cumulative, name in sorted(lines, reverse=True)[:15]:
+        print '{:10.3f} ms {}'.format(cumulative / 1000.0, name)
+
+def startup(options):
+    """cold start cost of lib and of every device module"""
+    interpreter = coldStart('pass', options.runs)
+    print 'interpreter start: {:.3f} s'.format(interpreter)
+    for module in ('lib', 'lirc', 'denon', 'yamaha', 'lgtv', 'gembird', 'vdr', 'pioneer', 'halirc'):
+        elapsed = coldStart('import %s' % module, options.runs) - interpreter
+        print 'import {:10} {:.3f} s'.format(module + ':', elapsed)
+    if options.importtime:
+        importTime('lib')
+
+def lirc(options):
+    """lines per second for parsing lircd lines into a LircMessage and
+    for matching them against some triggers, like Hal.eventReceived does"""
+    sys.path.insert(0, HERE)
+    from lirc import LircMessage
+    buttons = ('Up', 'Down', 'Left', 'Right', 'Ok', 'VolUp', 'VolDown', 'Mute')
+    lines = ['000000037ff07b{:02x} {:02x} {} AcerP1165'.format(idx, idx % 5, buttons[idx % len(buttons)])
+        for idx in range(1000)]
+    triggers = [LircMessage('AcerP1165.{}.*'.format(x)) for x in buttons]
+    triggers.append(LircMessage('"My other remote".Ok'))
+    def parse():
+        """parse only"""
+        for line in lines:
+            LircMessage(encoded=line)
+    def parseAndMatch():
+        """what every frame costs"""
+        for line in lines:
+            msg = LircMessage(encoded=line)
+            for trigger in triggers:
+                msg.matches(trigger)
+    for name, func in (('parse', parse), ('parse and match', parseAndMatch)):
+        times = []
+        for _ in range(options.runs):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        print 'lirc {:16} {:10.0f} lines/s'.format(name + ':', len(lines) / median(times))
+
+BENCHMARKS = {'startup': startup, 'lirc': lirc}
+
+def main():
+    """run the wanted benchmarks"""
+    parser = OptionParser(usage='%prog [options] [{}]'.format('|'.join(sorted(BENCHMARKS))))
+    parser.add_option('--runs', dest='runs', type='int', default=5,
+        help='repeat every measurement RUNS times and use the median')
+    parser.add_option('--importtime', dest='importtime', action='store_true', default=False,
+        help='also show the most expensive imports of lib')
+    options, args = parser.parse_args()
+    for name in args or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+        BENCHMARKS[name](options)
+
+if __name__ == '__main__':
+    main()
@@ -19,13 +19,12 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import datetime
+import datetime, json
 
-from lib import Message, Serializer, elapsedSince
-from twisted.protocols.basic import LineOnlyReceiver
+from lib import Message, Serializer, FramedReceiver, Readiness, Request, LOGGER, logDebug, \
+    elapsedSince, inBackground, stateFile, writeAtomic
 from twisted.internet import reactor
-from twisted.internet.defer import succeed
-from twisted.internet.serialport import SerialPort
+from twisted.internet.defer import DeferredList, FirstError, succeed
 
 
 class DenonMessage(Message):
@@ -66,21 +65,33 @@ class DenonMessage(Message):
         else:
             return Message.answerMatches(self, answer)
 
-class Denon(LineOnlyReceiver, Serializer):
+class Denon(FramedReceiver, Serializer):
     """talk to a Denon AVR 2805 or similar"""
     delimiter = '\r'
     message = DenonMessage
     poweronCommands = ('SI')
+    statusCommands = ('PW', 'TP', 'MU', 'SI', 'MV', 'MS', 'TF', 'CV', 'Z2', 'TM', 'ZM')
+    stateAttributes = ('mutedVolume', 'surroundIdx', 'lastSurroundTime')
     delays = {'PW..': 1.5, '..PW': 0.02}
+    capabilityFile = 'denon.json' # in the state directory, see stateFile
+    probeTimeout = 0.5 # the Denon answers within 0.2 seconds or not at all
+    probeWindow = 3 # probes queued at the same time
+    probeBatch = 36 # save after so many probes
 
-    def __init__(self, hal, device='/dev/denon', outlet=None):
-        """default device is /dev/denon"""
+    def __init__(self, hal, device='/dev/denon', outlet=None, model='AVR-2805'):
+        """default device is /dev/denon. What discover() learns is
+        saved per model"""
+        self.model = model
+        self.__capabilities = None
+        self.__discovering = False
         self.mutedVolume = None
         # never close because the Denon sends events
         # by its own if it is operated by other means (IR, front knobs)
         self.surroundIdx = 0
         self.lastSurroundTime = None
         Serializer.__init__(self, hal, outlet)
+        self.readiness = Readiness(self, 'PW')
+        from twisted.internet.serialport import SerialPort
         self.__port = SerialPort(self, device, reactor)
 
     @staticmethod
@@ -124,25 +135,120 @@ class Denon(LineOnlyReceiver, Serializer):
         else:
             return Serializer.send(self, *args)
 
+    @staticmethod
+    def allCommands():
+        """every two letter command the Denon might know"""
+        letters1 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        letters2 = letters1 + '1234567890'
+        return list(x + y for x in letters1 for y in letters2)
+
+    def capabilities(self):
+        """what we know about our model: a dict with the lists
+        probed and supported"""
+        if self.__capabilities is None:
+            try:
+                with open(stateFile(self.capabilityFile)) as capFile:
+                    models = json.load(capFile)
+            except (IOError, ValueError):
+                models = {}
+            found = models.get(self.model, {})
+            self.__capabilities = dict((x, list(str(y) for y in found.get(x, []))) for x in ('probed', 'supported'))
+        return self.__capabilities
+
+    def saveCapabilities(self):
+        """other models in the file are kept"""
+        path = stateFile(self.capabilityFile)
+        try:
+            with open(path) as capFile:
+                models = json.load(capFile)
+        except (IOError, ValueError):
+            models = {}
+        models[self.model] = self.capabilities()
+        writeAtomic(path, json.dumps(models, indent=1, sort_keys=True))
+
+    def supportedCommands(self):
+        """the commands discover() found, None if it has not finished"""
+        capabilities = self.capabilities()
+        if len(capabilities['probed']) < len(self.allCommands()):
+            return None
+        return capabilities['supported']
+
+    def discover(self, dummyResult=None):
+        """find out which commands the Denon answers. Probes time out
+        after probeTimeout without disturbing the queue. Only probeWindow
+        of them are queued at a time, so other requests never wait long
+        behind them. Every probeBatch probes the result is saved, so an
+        interrupted discovery goes on where it stopped. Everything runs
+        in the background. The Denon should be on, in standby it answers
+        only a few commands. Fires with the supported commands, or None
+        if discovery is already running."""
+        if self.__discovering:
+            return succeed(None)
+        capabilities = self.capabilities()
+        probed = set(capabilities['probed'])
+        todo = list(x for x in self.allCommands() if x not in probed)
+        unsaved = []
+        def probe(command):
+            """a question which may go unanswered"""
+            request = Request(self, self.question(command), maxWaitSeconds=self.probeTimeout)
+            request.isProbe = True
+            return self.tasks.push(request)
+        def window(dummyResult):
+            """probe the next few commands"""
+            if not todo:
+                self.__discovering = False
+                LOGGER.info('{} {} supports {}'.format(
+                    self.name(), self.model, ' '.join(capabilities['supported'])))
+                return capabilities['supported']
+            commands = todo[:self.probeWindow]
+            del todo[:self.probeWindow]
+            return DeferredList(list(probe(x) for x in commands), fireOnOneErrback=True,
+                consumeErrors=True).addCallback(gotWindow, commands)
+        def gotWindow(results, commands):
+            """remember what we learned, save it now and then"""
+            for command, (_, answer) in zip(commands, results):
+                capabilities['probed'].append(command)
+                if answer is not None:
+                    capabilities['supported'].append(command)
+            unsaved.extend(commands)
+            if len(unsaved) >= self.probeBatch or not todo:
+                self.saveCapabilities()
+                del unsaved[:]
+                logDebug(self, 'f', '{}: {} commands left to probe'.format(self.name(), len(todo)))
+            return window(None)
+        def failed(result):
+            """cancelled, the next discover() goes on"""
+            self.__discovering = False
+            if unsaved:
+                self.saveCapabilities()
+            if result.check(FirstError):
+                return result.value.subFailure
+            return result
+        def discovery(dummyResult):
+            """the whole chain, so failed() also sees a cancellation"""
+            return succeed(None).addCallback(window).addErrback(failed)
+        self.__discovering = True
+        # hundreds of questions, do not block remote control actions
+        return inBackground(discovery, None)
+
+    def discoveryFailed(self, result):
+        """log and end the chain"""
+        LOGGER.error('{}: discovery ended: {}'.format(self.name(), result.getErrorMessage()))
+
     def queryStatus(self, dummyResult, full=False):
-        """query Denon status. If full, try to query even those
-        parameters we do not know about"""
+        """query Denon status. If full, also query those parameters
+        we do not know about. That needs discover(), which is only
+        done once per model"""
         if full:
-            letters1 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-            letters2 = letters1 + '1234567890'
-            commands = []
-            for letter1 in letters1:
-                for letter2 in letters2:
-                    commands.append(letter1 + letter2)
-        else:
-            # only query commands that might actually exist.
-            # if full query finds more, please add them here
-            commands = ['PW', 'TP', 'MU', 'SI',
-                'MV', 'MS', 'TF', 'CV', 'Z2', 'TM', 'ZM']
-        deferred = succeed(None)
-        for command in commands:
-            deferred.addCallback(self.ask, command)
-        return deferred
+            supported = self.supportedCommands()
+            if supported is None:
+                return self.discover().addCallback(
+                    lambda x: x and inBackground(self.queryMany, x)).addErrback(self.discoveryFailed)
+            return inBackground(self.queryMany, supported)
+        # only query commands that might actually exist
+        commands = list(self.statusCommands)
+        commands.extend(x for x in self.supportedCommands() or [] if x not in commands)
+        return self.queryMany(commands)
 
     def volume(self, dummyResult, newValue):
         """change volume up or down or to a discrete value"""
@@ -157,19 +263,22 @@ class Denon(LineOnlyReceiver, Serializer):
         return self.ask('PW').addCallback(_volume1, newValue)
 
     def mute(self, dummyResult=None):
-        """toggle between mute/unmuted"""
-        def _mute1(result):
-            """result is ON or STANDBY"""
-            if result.value() != 'ON':
+        """toggle between mute/unmuted. With power in the state
+        cache, unmuting is a single write. For muting we always ask
+        MV: the cache key is the first two characters, so MVMAX
+        overwrites the volume there"""
+        oldMutedVolume = self.mutedVolume
+        def _mute1(power, volume=None):
+            """power is ON or STANDBY, volume is the volume before muting"""
+            if not power or power.value() != 'ON':
                 return succeed(None)
             if self.mutedVolume:
                 newMV = self.mutedVolume
                 self.mutedVolume = None
                 return self.push('MV%s' % newMV)
-            return self.ask('MV').addCallback(_mute2)
-        def _mute2(result):
-            """result is the volume before unmuting"""
-            self.mutedVolume = result.value()
+            if not volume:
+                return self.ask('MV').addCallback(lambda x: _mute1(power, x))
+            self.mutedVolume = volume.value()
             if self.mutedVolume < '25':
                 # denon was muted when halirc started
                 self.mutedVolume = None
@@ -177,7 +286,10 @@ class Denon(LineOnlyReceiver, Serializer):
             else:
                 newMV = '20'
             return self.push('MV%s' % newMV)
-        return self.ask('PW').addCallback(_mute1)
+        def rollback():
+            """the Denon did not do what we predicted"""
+            self.mutedVolume = oldMutedVolume
+        return self.speculate(('PW', ), _mute1, rollback=rollback)
 
     def surround(self, dummyEvent, osdCatEnabled, cycle):
         """cycle surround things between our preferred values"""
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+A lightweight event bus between halirc nodes on different machines.
+A node publishes the events of its own devices and remote controls to
+its peers and passes the events it gets from them to its Hal, with
+their original time, so triggers with several parts work across nodes.
+Events from peers are not published again: either connect every node
+with every other node, or define publish and subscribe filters.
+Configure the peers on one side of a connection only.
+
+In setup():
+
+    EventBus(self, 'shop', port=8642, peers=[('office', 8642)])
+"""
+
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.protocols.loopback import loopbackAsync
+
+from lib import LOGGER, SerializerMeta, dumpEvent, loadEvent, logDebug
+
+# a frame is a batch of events:
+#   version, length of node name, node name, number of events
+#   and for every event: time, length of class name, length of
+#   decoded, class name, decoded
+FRAME = struct.Struct('!BB')
+COUNT = struct.Struct('!H')
+EVENT = struct.Struct('!dBH')
+VERSION = 1
+
+def encodeFrame(node, events):
+    """a batch of events as a binary frame"""
+    parts = [FRAME.pack(VERSION, len(node)), node, COUNT.pack(len(events))]
+    for event in events:
+        className, decoded, when = dumpEvent(event)
+        if isinstance(decoded, unicode):
+            decoded = decoded.encode('utf-8')
+        parts.append(EVENT.pack(when, len(className), len(decoded)))
+        parts.append(className)
+        parts.append(decoded)
+    return ''.join(parts)
+
+def decodeFrame(frame):
+    """returns the sending node and its events"""
+    version, nodeLength = FRAME.unpack_from(frame)
+    if version != VERSION:
+        raise ValueError('unknown event bus frame version {}'.format(version))
+    offset = FRAME.size
+    node = frame[offset:offset + nodeLength]
+    offset += nodeLength
+    count, = COUNT.unpack_from(frame, offset)
+    offset += COUNT.size
+    events = []
+    for _ in range(count):
+        when, classLength, decodedLength = EVENT.unpack_from(frame, offset)
+        offset += EVENT.size
+        className = frame[offset:offset + classLength]
+        offset += classLength
+        decoded = frame[offset:offset + decodedLength]
+        offset += decodedLength
+        events.append(loadEvent(className, decoded, when))
+    return node, events
+
+class BusProtocol(Int32StringReceiver):
+    """one connection to a peer, in either direction"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def connectionMade(self):
+        """a peer connected"""
+        self.bus.protocols.append(self)
+
+    def connectionLost(self, dummyReason=None):
+        """forget this peer"""
+        if self in self.bus.protocols:
+            self.bus.protocols.remove(self)
+
+    def stringReceived(self, string):
+        """a frame with events from a peer"""
+        try:
+            node, events = decodeFrame(string)
+        except (ValueError, KeyError, struct.error) as exc:
+            LOGGER.error('EventBus: dropping bad frame: {}'.format(exc))
+            return
+        self.bus.eventsReceived(node, events)
+
+class BusClientFactory(ReconnectingClientFactory):
+    """connects to a peer and reconnects if needed"""
+    maxDelay = 30
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def buildProtocol(self, dummyAddr):
+        """connected to a peer"""
+        self.resetDelay()
+        return BusProtocol(self.bus)
+
+class EventBus(Factory, object):
+    """publishes our events to peers and receives theirs.
+    Attributes:
+        node        the name of this node, must be unique on the bus
+        publish     None or a callable: only publish events for which it returns True
+        subscribe   None or a callable: only accept events for which it returns True
+        batchDelay  collect events for so many seconds before sending them as one frame
+        maxBatch    send at once when so many events are waiting
+    Like devices, constructing an EventBus with the same node, port
+    and peers again returns the existing one with the new filters,
+    so Hal.reload does not rebind.
+    """
+    # pylint: disable=R0913
+    __metaclass__ = SerializerMeta
+    batchDelay = 0.005
+    maxBatch = 200
+
+    def __init__(self, hal, node, port=None, peers=None, publish=None, subscribe=None):
+        self.hal = hal
+        self.node = node
+        self.publish = publish
+        self.subscribe = subscribe
+        self.protocols = []
+        self.pending = []
+        self.__flushCall = None
+        hal.eventForwarders.append(self.eventReceived)
+        if port is not None:
+            reactor.listenTCP(port, self)
+        for host, peerPort in peers or []:
+            reactor.connectTCP(host, peerPort, BusClientFactory(self))
+
+    @staticmethod
+    def reuseKey(*args, **kwargs):
+        """node, port and peers identify us. The filters are new
+        callables after every reload"""
+        names = ('node', 'port', 'peers')
+        values = dict(zip(names, args))
+        values.update((x, kwargs[x]) for x in names if x in kwargs)
+        return tuple(values.get(x) for x in names)
+
+    def reconfigure(self, node, port=None, peers=None, publish=None, subscribe=None):
+        """reload passes the filters again"""
+        # pylint: disable=W0613
+        self.publish = publish
+        self.subscribe = subscribe
+
+    def buildProtocol(self, dummyAddr):
+        """a peer connected to us"""
+        return BusProtocol(self)
+
+    def connectLoopback(self, other):
+        """connect two buses in this process without a socket. For testing"""
+        return loopbackAsync(BusProtocol(self), BusProtocol(other))
+
+    def eventReceived(self, event):
+        """an event from our own devices, a Hal.eventForwarders entry"""
+        if self.publish and not self.publish(event):
+            return
+        self.pending.append(event)
+        if len(self.pending) >= self.maxBatch:
+            self.flush()
+        elif not self.__flushCall:
+            self.__flushCall = reactor.callLater(self.batchDelay, self.flush)
+
+    def flush(self):
+        """send all pending events as one frame"""
+        if self.__flushCall and self.__flushCall.active():
+            self.__flushCall.cancel()
+        self.__flushCall = None
+        events, self.pending = self.pending, []
+        if events and self.protocols:
+            frame = encodeFrame(self.node, events)
+            for protocol in self.protocols:
+                protocol.sendString(frame)
+
+    def eventsReceived(self, node, events):
+        """a peer sent us events"""
+        if node == self.node:
+            return
+        for event in events:
+            if self.subscribe and not self.subscribe(event):
+                continue
+            logDebug(None, 'e', 'event {} from node {}'.format(event, node))
+            self.hal.eventReceived(event, remote=True)
@@ -52,6 +52,7 @@ class GembirdMessage(Message):
         outlet1:off   switches off
         outlet1       asks for status
         instead of 1 you can also use 2,3,4
+        outletall     asks for the status of all outlets
     """
     commands = {}
     for _ in ('1', '2', '3', '4', 'all'):
@@ -67,16 +68,31 @@ class GembirdMessage(Message):
         if encoded is not None:
             if encoded == '': # timeout
                 return
-            parts = encoded.split('\n')[1].split() # the first line says 'accessing...'
+            # the first line says 'accessing...'
+            lines = list(x for x in encoded.split('\n')[1:] if x.strip())
+            if len(lines) > 1:
+                # the answer to outletall
+                self.outlet = 'all'
+                self._encoded = '-g all'
+                self._decoded = 'outletall:' + ' '.join(
+                    '{}={}'.format(x.split()[-2][0], x.split()[-1]) for x in lines)
+                return
+            parts = lines[0].split()
             self.outlet = parts[-2][0]
             assert self.outlet in '1234', encoded
             assert parts[-1] in ('on', 'off'), encoded
             if parts[-1] == 'on':
                 self._encoded = '-o %s' % self.outlet
-                self._decoded = 'outlet%s:on'
+                self._decoded = 'outlet%s:on' % self.outlet
             else:
                 self._encoded = '-f %s' % self.outlet
-                self._decoded = 'outlet%s:off'
+                self._decoded = 'outlet%s:off' % self.outlet
+        elif decoded.startswith('outletall'):
+            # all outlets at once: outletall:1=on 2=off 3=off 4=on
+            self.outlet = 'all'
+            self._decoded = decoded
+            self._encoded = '-g all'
+            self.isQuestion = ':' not in decoded
         else: # decoded
             assert decoded.startswith('outlet'), decoded
             self.outlet = decoded[6]
@@ -124,6 +140,10 @@ class GembirdOutlet(object):
         """compute necessary delay before we can execute request"""
         return self.gembird.delay(previous, this)
 
+    def __repr__(self):
+        """stable across restarts, used for identifying devices"""
+        return 'GembirdOutlet({})'.format(self.outlet)
+
     def poweron(self, *dummyArgs):
         """switch power on"""
         return self.gembird.poweron(self.outlet)
@@ -137,6 +157,7 @@ class Gembird(Serializer):
     the Gembird USB power outlet"""
 
     message = GembirdMessage
+    statusCommands = ('outlet1', 'outlet2', 'outlet3', 'outlet4')
 
     def __init__(self, hal, device='/dev/steckerleiste', outlets=4):
         Serializer.__init__(self, hal)
@@ -156,6 +177,28 @@ class Gembird(Serializer):
             return 0.7
         return 0
 
+    def queryMany(self, commands):
+        """sispmctl -g all returns all outlets with one USB access"""
+        if len(list(x for x in commands if x.startswith('outlet'))) < 2:
+            return Serializer.queryMany(self, commands)
+        result = {}
+        def gotAll(answer):
+            """put the single outlets into the state cache"""
+            if answer and answer.outlet == 'all' and answer.value():
+                for part in answer.value().split():
+                    outlet, value = part.split('=')
+                    self.remember(self.message('outlet{}:{}'.format(outlet, value)))
+                    result['outlet' + outlet] = value
+            missing = list(x for x in commands if x not in result)
+            if not missing:
+                return dict((x, result[x]) for x in commands)
+            return Serializer.queryMany(self, missing).addCallback(gotMissing)
+        def gotMissing(values):
+            """merge the separately asked values"""
+            result.update(values)
+            return dict((x, result[x]) for x in commands)
+        return self.ask('outletall').addCallback(gotAll)
+
     def lineReceived(self, data):
         """nothing special here"""
         Serializer.defaultInputHandler(self, data)
@@ -22,17 +22,16 @@ Everything in halirc.py is just an example. You want to start
 your own myhalirc.py and do there whatever you want.
 """
 
-import os
+from twisted.internet.defer import succeed
 
-from twisted.internet.defer import succeed, DeferredList
-
-from lib import LOGGER, Hal, main, OsdCat
+from lib import LOGGER, Hal, main, OsdCat, PowerSequencer, runProcess
 from lirc import Lirc
 from gembird import Gembird
 from lgtv import LGTV
 from yamaha import Yamaha
 from vdr import Vdr
 from pioneer import Pioneer
+from snapshot import Snapshot
 
 class MorningAction(object):
     """very custom..."""
@@ -58,11 +57,6 @@ class MorningAction(object):
         if self.vdr.prevChannel:
             self.vdr.gotoChannel(None, self.vdr.prevChannel)
 
-def allOff(dummyEvent, devices):
-    """as the name says. Will be called if the Yamaha is powered
-    off - the LG does not make sense without Yamaha"""
-    return DeferredList([x.standby() for x in devices])
-
 class MyHal(Hal):
     """an example for user definitions"""
 
@@ -83,10 +77,9 @@ class MyHal(Hal):
             return succeed(None)
 
     @staticmethod
-    def kodi(event, vdr):
+    def kodi(dummyEvent, vdr):
         """toggle between kodi and vdr"""
-        os.system("chvt 7")
-        return vdr.toggleSofthddevice(event)
+        return runProcess(['chvt', '7'], owner=vdr).addCallback(vdr.toggleSofthddevice)
 
     def setup(self):
         """
@@ -102,11 +95,20 @@ class MyHal(Hal):
         lirc = Lirc(self)
         yamaha = Yamaha(self, host='yamaha')
         vdr = Vdr(self)
+        vdr.followSyslog()
         lgtv = LGTV(self)
-        osdcat = OsdCat()
+        osdcat = OsdCat(self)
         gembird = Gembird(self)
         pioneer = Pioneer(self, host='pioneer', outlet=gembird[3])
         self.yamaha = yamaha
+        # the LG and the Pioneer do not make sense without Yamaha
+        lgtv.dependencies = [yamaha]
+        pioneer.dependencies = [yamaha]
+        # shorten the hand tuned delays where the devices allow it.
+        # The LG handles power badly, never learn delays after that
+        yamaha.learnDelays()
+        lgtv.learnDelays(exempt=('power', ))
+        power = PowerSequencer([yamaha, lgtv, pioneer])
         for cmd in ('@MAIN:VOL', ):
             self.addRepeatableTrigger(yamaha, cmd, self.gotYamahaEvent, osdcat)
 
@@ -128,10 +130,15 @@ class MyHal(Hal):
         self.addTrigger(lirc, 'Denon_AVR2805.Channel-', yamaha.send, '@TUN:PRESET=Down')
         self.addTrigger(lirc, 'Denon_AVR2805.Tuning+', yamaha.send, '@TUN:FMFREQ=Auto Up')
         self.addTrigger(lirc, 'Denon_AVR2805.Tuning-', yamaha.send, '@TUN:FMFREQ=Auto Down')
-        self.addTrigger(lirc, 'AcerP1165.Left', yamaha.poweron)
-        self.addTrigger(lirc, 'AcerP1165.Right', allOff, [yamaha, lgtv, pioneer])
+        # if I change my mind, do not first finish what I do not want anymore
+        self.addTrigger(lirc, 'AcerP1165.Left', yamaha.poweron).group = 'power'
+        self.addTrigger(lirc, 'AcerP1165.Right', power.standby).group = 'power'
         self.addRepeatableTrigger(lirc, 'AcerP1165.Down', yamaha.volume, 'Down')
         self.addRepeatableTrigger(lirc, 'AcerP1165.Up', yamaha.volume, 'Up')
+        # a held key fires once. For steps while the key is held, getting
+        # faster after a second, match all repeats and give a lib.RatePolicy:
+        # trgr = self.addRepeatableTrigger(lirc, 'AcerP1165.Up.*', yamaha.volume, 'Up')
+        # trgr.rate = RatePolicy(maxRate=3, accelerate=[(1, 6), (2, 10)])
 
         for vdrKey in ('Ok', 'Channel+', 'Channel-', 'Menu', 'EPG', 'Info', 'Right',
             'Left', 'Up', 'Down', 'REC', 'Red', 'Green', 'Blue', 'Yellow',
@@ -146,8 +153,8 @@ class MyHal(Hal):
         self.addTrigger(lirc, 'Receiver12V.4', lgtv.send, 'input:Component')
         self.addTrigger(lirc, 'Receiver12V.5', lgtv.send, 'input:DTV')
 
-        self.addTrigger(lirc, 'Receiver12V.6', pioneer.poweron, yamaha)
-        self.addTrigger(lirc, 'Receiver12V.7', pioneer.standby)
+        self.addTrigger(lirc, 'Receiver12V.6', power.poweron, pioneer).group = 'power'
+        self.addTrigger(lirc, 'Receiver12V.7', pioneer.standby).group = 'power'
         self.addTrigger(lirc, 'XoroDVD.PlayPause', pioneer.play)
         self.addTrigger(lirc, 'XoroDVD.Angle', pioneer.send, 'ST')
         self.addTrigger(lirc, 'XoroDVD.Left', pioneer.send, '/A187FFFF/RU')
@@ -164,6 +171,9 @@ class MyHal(Hal):
         self.addRepeatableTrigger(lirc, 'AcerP1165.Zoom', self.kodi, vdr)
         self.addRepeatableTrigger(lirc, 'AcerP1165.Source', lgtv.aspect, ('scan', '4:3', '14:9'))
         MorningAction(self, vdr, yamaha)
+        Snapshot(self)
 
-# do not change this:
-main(MyHal)
+# do not change this. Configurations calling main(MyHal) without
+# this condition still work, but reload ignores that call:
+if __name__ == '__main__':
+    main(MyHal)
@@ -21,12 +21,21 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import sys, os, datetime
 
-from twisted.protocols.basic import LineOnlyReceiver
 from twisted.internet.defer import succeed
 from twisted.internet import reactor
-from twisted.internet.serialport import SerialPort
 
-from lib import Message, Serializer, LOGGER, elapsedSince
+from lib import Message, Serializer, FramedReceiver, Readiness, LOGGER, elapsedSince
+
+def reverseLookups(commands, values):
+    """for LGTVMessage: byCmd2 maps the second character of a command,
+    which is all the answer returns, to a list of human commands.
+    encodedValues maps human values to codes, per human command"""
+    byCmd2 = {}
+    for humanCmd, cmd in commands.items():
+        byCmd2.setdefault(cmd[1], []).append(humanCmd)
+    encodedValues = dict((humanCmd, dict((y, x) for x, y in humanValues.items()))
+        for humanCmd, humanValues in values.items())
+    return byCmd2, encodedValues
 
 class LGTVMessage(Message):
     """holds content of a message from or to a LG TV"""
@@ -59,6 +68,9 @@ class LGTVMessage(Message):
     for volume in range(0, 64):
         values['volume']['%02x' % volume] = str(volume)
 
+    # reverse lookups, so parsing needs no searching
+    byCmd2, encodedValues = reverseLookups(commands, values)
+
     def __init__(self, decoded=None, encoded=None):
         self.setID = '01'
         Message.__init__(self, decoded, encoded)
@@ -67,33 +79,37 @@ class LGTVMessage(Message):
         """The LG interface is a bit
         stupid: When sending, we send two characters for the command
         like ka or ma. But the answer only returns the second character,
-        so we cannot easily find the corresponding full command"""
+        so we cannot easily find the corresponding full command.
+        Answers have fixed width fields like 'a 01 OK01', so
+        we parse them by position."""
         if encoded is not None:
-            parts = encoded.split(' ')
-            if len(parts) < 3:
+            if len(encoded) < 7 or encoded[1] != ' ' or encoded[4] != ' ':
+                self._decoded = ':'
+                return
+            cmd2 = encoded[0]
+            self.setID = encoded[2:4]
+            self.status = encoded[5:7]
+            encodedValue = encoded[7:9]
+            humanCommands = self.byCmd2.get(cmd2)
+            if not humanCommands:
+                LOGGER.error('answer from LG matches no command: {}'.format(encoded))
                 self._decoded = ':'
+                self._encoded = encoded
                 return
-            self.status = parts[2][:2]
-            cmd2 = parts[0]
-            self.status = parts[2][:2]
-            encodedValue = parts[2][2:]
-            items = [x for x in self.commands.items() if x[1][1] == cmd2]
-            if len(items) > 1:
-                LOGGER.error('answer from LG matches more than 1 command: {}'.format(items))
-            elif len(items) == 0:
-                LOGGER.error('answer from LG matches no command: {}'.format(self.encoded))
-            humanCommand = items[0][0]
+            if len(humanCommands) > 1:
+                LOGGER.error('answer from LG matches more than 1 command: {}'.format(humanCommands))
+            humanCommand = humanCommands[0]
             if encodedValue:
-                decodedValue = self.values[humanCommand][encodedValue]
+                decodedValue = self.values[humanCommand].get(encodedValue, encodedValue)
             else:
                 decodedValue = 'None'
-            self._decoded = ':'.join([humanCommand, decodedValue])
+            self._decoded = humanCommand + ':' + decodedValue
         else: # decoded
             self._decoded = decoded
             humanCommand = self.humanCommand()
             humanValue = self.value()
             if humanValue:
-                encodedValue = [x[0] for x in self.values[humanCommand].items() if x[1] == humanValue][0]
+                encodedValue = self.encodedValues[humanCommand][humanValue]
             else:
                 self.isQuestion = True
                 encodedValue = 'ff'
@@ -115,17 +131,23 @@ class LGTVMessage(Message):
         """the command of this message, encoded"""
         return self._encoded.split()[0]
 
-class LGTV(LineOnlyReceiver, Serializer):
+class LGTV(FramedReceiver, Serializer):
     """Interface to probably most LG flatscreens"""
-    delimiter = 'x' # for LineOnlyReceiver
+    delimiter = 'x' # for FramedReceiver
     message = LGTVMessage
     poweronCommands = ('input')
+    statusCommands = ('power', 'mutescreen', 'aspect', 'input')
+    stateAttributes = ('videoMuted', )
 
     def __init__(self, hal, device='/dev/LGPlasma', outlet=None):
         Serializer.__init__(self, hal, outlet)
         self.device = device
         self.videoMuted = None
         self.tvTimeout = 300
+        self.readiness = Readiness(self, 'power')
+        # if we send commands too early after power:on, the LG might
+        # ignore them or return garbage or become unresponsive
+        self.poweronReadiness = Readiness(self, 'power', maxWait=6, minWait=2, accept=self.isOn)
         self.connect()
 
     def connect(self):
@@ -135,6 +157,7 @@ class LGTV(LineOnlyReceiver, Serializer):
             LOGGER.info('LGTV: {} does not exist, waiting for 0.1 seconds'.format(self.device))
             reactor.callLater(0.1, self.connect)
         else:
+            from twisted.internet.serialport import SerialPort
             SerialPort(self, self.device, reactor)
             self.connected = True
             LOGGER.info('LGTV: connected to {}'.format(self.device))
@@ -146,20 +169,48 @@ class LGTV(LineOnlyReceiver, Serializer):
         reactor.callLater(5, self.connect)
 
     @staticmethod
-    def delay(previous, dummyThis):
+    def isOn(answer):
+        """the LG says it is on"""
+        return answer.value() == 'on'
+
+    def delay(self, previous, this):
         """compute delay between two requests. If we send commands
         while the LG is powering on or off, it might ignore them
-        or return garbage or become unresponsive to further commands"""
+        or return garbage or become unresponsive to further commands.
+        After power:on, poweronReadiness does the waiting."""
         cmd1 = previous.message.decoded if previous else ''
         result = 0
         if cmd1 == 'power:on':
-            # poweron is faster!
-            result = 6
+            if this.isProbe or self.poweronReadiness.confirmedSince(previous.sendTime):
+                result = 0
+            else:
+                # poweron is faster!
+                result = 6
         elif cmd1 == 'power:off':
             # poweroff needs EIGHT seconds!
             result = 8
         return result
 
+    def queryMany(self, commands):
+        """the LG has no bulk query, but when it is off it only
+        answers for power. So ask for power first and do not wait
+        for the timeouts of all other questions"""
+        others = list(x for x in commands if x != 'power')
+        def gotPower(power):
+            """only ask the others if the LG is on"""
+            result = {}
+            if 'power' in commands:
+                result['power'] = power.value() if power else None
+            if not power or not self.isOn(power):
+                result.update((x, None) for x in others)
+                return result
+            def gotOthers(values):
+                """merge"""
+                result.update(values)
+                return result
+            return Serializer.queryMany(self, others).addCallback(gotOthers)
+        return self.ask('power').addCallback(gotPower)
+
     def init(self):
         """init the LGTV for VDR usage"""
         self.videoMuted = None
@@ -170,7 +221,8 @@ class LGTV(LineOnlyReceiver, Serializer):
 
     def _poweron(self, *dummyArgs):
         """power on the LGTV"""
-        return self.send('power:on').addCallback(self.send, 'mutescreen:off')
+        return self.send('power:on').addCallback(
+            self.poweronReadiness.wait).addCallback(self.send, 'mutescreen:off')
 
     def _standby(self, *dummyArgs):
         """power off the LGTV"""
@@ -182,20 +234,24 @@ class LGTV(LineOnlyReceiver, Serializer):
             return self.standby(None)
 
     def mutescreen(self, event, muteButton, receiver):
-        """except for muteButton, all remote buttons make video visible again"""
-        def got1(answer):
-            """got answer"""
-            if answer.value() != 'on':
+        """except for muteButton, all remote buttons make video visible again.
+        With power and mutescreen in the state cache, this is a single write"""
+        oldVideoMuted = self.videoMuted
+        def got1(power, answer=None):
+            """got answers"""
+            if not power or power.value() != 'on':
                 return self.init()
-            else:
+            elif answer is None:
                 return self.ask('mutescreen').addCallback(got2)
+            else:
+                return got2(answer)
         def got2(answer):
             """got answer"""
-            if answer.value() == 'on' or event.button != muteButton:
+            if not answer or answer.value() == 'on' or event.button != muteButton:
                 newValue = 'off'
             else:
                 newValue = 'on'
-            if answer.value() == newValue:
+            if answer and answer.value() == newValue:
                 return succeed(None)
             if newValue == 'on':
                 self.videoMuted = datetime.datetime.now()
@@ -204,18 +260,27 @@ class LGTV(LineOnlyReceiver, Serializer):
             else:
                 receiver.poweron()
                 return self.init()
-        return self.ask('power').addCallback(got1)
+        def rollback():
+            """the LG did not do what we predicted"""
+            self.videoMuted = oldVideoMuted
+        # only ask for mutescreen if the LG is on
+        questions = ('power', 'mutescreen') if self.predict('mutescreen') else ('power', )
+        return self.speculate(questions, got1, verify=('power', ), rollback=rollback)
 
     def aspect(self, dummyEvent, cycle):
-        """cycle aspect ratio between our preferred values"""
+        """cycle aspect ratio between our preferred values, starting
+        from the cached aspect if there is one. The LG answers the
+        write with the aspect it set, which refreshes the cache. If
+        the aspect is changed with the remote of the TV, we only
+        notice after predictionAge"""
         def got1(answer):
             """got answer"""
-            if answer.value() not in cycle:
+            if not answer or answer.value() not in cycle:
                 newValue = cycle[0]
             else:
                 newValue = (cycle + cycle)[cycle.index(answer.value()) + 1]
             return self.push('aspect:%s' % newValue)
-        return self.ask('aspect').addCallback(got1)
+        return self.speculate(('aspect', ), got1, verify=())
 
     def lineReceived(self, data):
         Serializer.defaultInputHandler(self, data)
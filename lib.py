@@ -18,15 +18,14 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import datetime, daemon, weakref, types, sys
+import datetime, weakref, types, sys, os, signal, time
 import logging, logging.handlers
-from optparse import OptionParser
+from collections import deque
 
 from twisted.internet import reactor
-from twisted.internet.protocol import ProcessProtocol
-from twisted.internet.defer import Deferred, succeed
-from twisted.protocols.basic import LineOnlyReceiver
-from twisted.conch.telnet import Telnet
+from twisted.internet.protocol import ProcessProtocol, Protocol
+from twisted.internet.defer import Deferred, DeferredList, succeed, CancelledError
+from twisted.internet.error import ProcessExitedAlready
 
 # this ugly code ensures that pylint gives no errors about
 # undefined attributes:
@@ -34,9 +33,30 @@ reactor.callLater = reactor.callLater
 reactor.run = reactor.run
 reactor.connectUNIX = reactor.connectUNIX
 reactor.spawnProcess = reactor.spawnProcess
-
-LOGGER = None
-OPTIONS = None
+reactor.callFromThread = reactor.callFromThread
+reactor.callWhenRunning = reactor.callWhenRunning
+reactor.addSystemEventTrigger = reactor.addSystemEventTrigger
+reactor.listenTCP = reactor.listenTCP
+reactor.connectTCP = reactor.connectTCP
+reactor.listenUNIX = reactor.listenUNIX
+
+class Options(object):
+    """the defaults as long as parseOptions has not been called"""
+    # pylint: disable=R0903
+    debug = ''
+    background = False
+    device = []
+    room = None
+    roomSocket = None
+    stateDir = '~/.halirc'
+
+# importing lib has no side effects: bootstrap() parses the command
+# line and sets up logging, main() calls it.
+LOGGER = logging.getLogger('halirc')
+OPTIONS = Options()
+
+# priority classes for requests, see ActionContext and RequestQueue
+INTERACTIVE, NORMAL, BACKGROUND = range(3)
 
 def elapsedSince(since):
     """return the seconds elapsed since 'since'"""
@@ -46,6 +66,8 @@ def elapsedSince(since):
 
 def scanDeviceIds():
     """TODO: this should happen dynamically, not hard coded"""
+    if Serializer.debugIds:
+        return
     Serializer.debugIds.append('Lirc')
     Serializer.debugIds.append('VDR')
     Serializer.debugIds.append('Yamaha')
@@ -54,8 +76,9 @@ def scanDeviceIds():
     Serializer.debugIds.append('LGTV')
     Serializer.debugIds.append('Pioneer')
 
-def parseOptions():
+def parseOptions(args=None):
     """should switch to argparse when debian stable has python 2.7"""
+    from optparse import OptionParser
     parser = OptionParser()
     parser.add_option('-d', '--debug', dest='debug',
         help="""DEBUG:
@@ -75,8 +98,14 @@ a sequence of characters: 's' shows data sent to appliances.
 If not given, show all.
 DEVICE: any of {}
         """.format(' '.join(Serializer.debugIds), default='', metavar='DEVICE'))
+    parser.add_option('--room', dest='room', default=None, metavar='ROOM',
+        help="""internal: run as worker process for ROOM. See rooms.py""")
+    parser.add_option('--roomsocket', dest='roomSocket', default=None, metavar='PATH',
+        help="""internal: the socket of the room supervisor""")
+    parser.add_option('--statedir', dest='stateDir', default=Options.stateDir, metavar='DIR',
+        help="""where halirc keeps what it learns about the devices. Default is %default""")
     global OPTIONS # pylint: disable=W0603
-    OPTIONS = parser.parse_args()[0]
+    OPTIONS = parser.parse_args(args)[0]
     if OPTIONS.debug == 'all':
         OPTIONS.debug = 'srepcft'
     if not OPTIONS.device:
@@ -87,8 +116,6 @@ DEVICE: any of {}
 def initLogger():
     """logging goes to stderr when running in foregrund, else
     to syslog"""
-    global LOGGER # pylint: disable=W0603
-    LOGGER = logging.getLogger('halirc')
     if OPTIONS.background:
         handler = logging.handlers.SysLogHandler('/dev/log')
     else:
@@ -105,6 +132,35 @@ def initLogger():
     LOGGER.info('halirc started with {}'.format(' '.join(sys.argv)))
     return LOGGER
 
+def bootstrap(args=None):
+    """everything needed before a Hal can run: parse the
+    command line and set up logging. Not again while reloading"""
+    if Hal.reloading:
+        return
+    scanDeviceIds()
+    parseOptions(args)
+    initLogger()
+
+def stateFile(name):
+    """the full path for a file in the state directory"""
+    directory = os.path.expanduser(OPTIONS.stateDir)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, name)
+
+def writeAtomic(path, data):
+    """after a crash, path holds either the old or the new data"""
+    tmpPath = path + '.new'
+    with open(tmpPath, 'wb') as tmpFile:
+        tmpFile.write(data)
+        tmpFile.flush()
+        os.fsync(tmpFile.fileno())
+    os.rename(tmpPath, path)
+
+def isDebugging(debugFlag):
+    """a cheap test before building an expensive debug message"""
+    return debugFlag in OPTIONS.debug
+
 def logDebug(obj, debugFlag, msg):
     """log something about obj"""
     if not debugFlag or debugFlag in OPTIONS.debug:
@@ -115,6 +171,91 @@ def logDebug(obj, debugFlag, msg):
             if any(x in msg for x in OPTIONS.device):
                 LOGGER.debug(msg)
 
+class ActionContext(object):
+    """what a chain of requests is done for. A Request takes the current
+    context when it is created. While a Request or sleep() fires its
+    callbacks, its context is current again. So all requests resulting
+    from a trigger action share its priority and its fate, even if
+    created much later in some callback.
+
+    cancel() errbacks all unsent requests and pending sleeps of the
+    context with CancelledError, and so will all requests created later
+    in it. A request still waiting for its delay is woken up and dropped.
+    A timeout in seconds is a deadline for the whole chain."""
+    current = None
+
+    def __init__(self, priority=NORMAL, name=None, timeout=None):
+        self.priority = priority
+        self.name = name
+        self.requests = set() # not yet fired
+        self.sleeps = set() # pending sleep() calls: (DelayedCall, Deferred)
+        self.cancelled = None # the reason
+        self.finished = False
+        self.__expiry = None
+        if timeout:
+            self.__expiry = reactor.callLater(
+                timeout, self.cancel, 'deadline of {} seconds passed'.format(timeout))
+
+    def cancel(self, reason):
+        """tear down the chain"""
+        if self.cancelled or self.finished:
+            return
+        self.cancelled = reason
+        self.done()
+        logDebug(None, 'f', 'ACTION cancelled: {}: {}'.format(self, reason))
+        for request in list(self.requests):
+            if request.called:
+                continue
+            if request is request.protocol.tasks.running:
+                # only stop it if it is not yet on its way
+                request.wakeUp()
+            else:
+                request.protocol.tasks.queued.remove(request)
+                request.errback(CancelledError('{}: {}'.format(self, reason)))
+        for delayedCall, deferred in list(self.sleeps):
+            self.sleeps.discard((delayedCall, deferred))
+            if delayedCall.active():
+                delayedCall.cancel()
+                deferred.errback(CancelledError('{}: {}'.format(self, reason)))
+
+    def done(self):
+        """the chain ended, forget the deadline"""
+        self.finished = True
+        if self.__expiry and self.__expiry.active():
+            self.__expiry.cancel()
+        self.__expiry = None
+
+    @staticmethod
+    def call(context, func, *args, **kwargs):
+        """call func with context being current"""
+        previous = ActionContext.current
+        ActionContext.current = context
+        try:
+            return func(*args, **kwargs)
+        finally:
+            ActionContext.current = previous
+
+    @staticmethod
+    def priorityOf(context):
+        """the priority for requests in context"""
+        return context.priority if context else NORMAL
+
+    def __str__(self):
+        return '{}/{}'.format(self.name, ('interactive', 'normal', 'background')[self.priority])
+
+def ignoreCancelled(result):
+    """errback for chains started without a trigger: a cancelled
+    chain is no error. Other failures are passed on"""
+    result.trap(CancelledError)
+    logDebug(None, 'f', 'ACTION cancelled: {}'.format(result.getErrorMessage()))
+
+def inBackground(func, *args, **kwargs):
+    """call func, all resulting requests have priority BACKGROUND"""
+    result = ActionContext.call(ActionContext(BACKGROUND, func.__name__), func, *args, **kwargs)
+    if isinstance(result, Deferred):
+        result.addErrback(ignoreCancelled)
+    return result
+
 class Timer(object):
     """hold attributes needed for a timer"""
     # pylint: disable=R0913
@@ -129,6 +270,12 @@ class Timer(object):
         self.month = month
         self.weekday = weekday
         self.lastDone = None
+        self.priority = NORMAL # for status sweeps, use BACKGROUND
+
+    def key(self):
+        """identifies the timer across configuration reloads"""
+        return (self.name or self.action.__name__, self.minute, self.hour,
+            self.day, self.month, self.weekday)
 
     def execute(self):
         """if this timer should be executed now, do so"""
@@ -148,13 +295,15 @@ class Timer(object):
                         if tValue != nValue:
                             return
             self.lastDone = now
-            if self.args:
-                self.action(*self.args)
-            else:
-                self.action()
+            result = ActionContext.call(ActionContext(self.priority, self.name), self.action, *(self.args or ()))
+            if isinstance(result, Deferred):
+                result.addErrback(ignoreCancelled)
 
 class Message(object):
     """holds content of a message from or to a device"""
+    # the priority of trigger actions started by this event
+    priority = NORMAL
+
     def __init__(self, decoded=None, encoded=None):
         assert (decoded is None) != (encoded is None), \
             'decoded:{} encoded:{}'.format(decoded, encoded)
@@ -165,9 +314,12 @@ class Message(object):
         self._encoded = None
         self._decoded = None
         self.isQuestion = False
+        self.stale = False # restored from a snapshot and not yet verified
         self.when = datetime.datetime.now()
-        self._setAttributes(decoded, encoded)
+        # before _setAttributes, which may set an error status like the LG NG
         self.status = 'OK' # the status returned from device: 'OK' or an error string
+        self.source = None # the device which sent this event
+        self._setAttributes(decoded, encoded)
 
     @apply
     def encoded(): # pylint: disable=E0202
@@ -215,6 +367,102 @@ class Message(object):
         else:
             return self == other
 
+class RatePolicy(object):
+    """decides which events of a burst a trigger executes, like the
+    repeat frames a held remote key produces about 10 times per second.
+    Dropped events cost nothing more than this decision. A policy holds
+    the state of the current burst, so every trigger needs its own.
+    Attributes:
+        quiet       a burst ends after so many seconds without events
+        leading     execute the first event of a burst
+        trailing    when a burst ends, execute its last event unless
+                    that has already been executed
+        maxRate     within a burst, execute at most so many events per
+                    second. None means no limit, 0 means only leading
+                    and trailing events
+        accelerate  a list of (seconds, maxRate): while the burst
+                    lasts longer than seconds, use that maxRate. Useful
+                    for volume: slow steps first, faster while held
+    """
+    # pylint: disable=R0913
+    def __init__(self, quiet=0.25, leading=True, trailing=False, maxRate=None, accelerate=None):
+        self.quiet = quiet
+        self.leading = leading
+        self.trailing = trailing
+        self.maxRate = maxRate
+        self.accelerate = sorted(accelerate or [])
+        self.burstStart = None
+        self.lastEvent = None
+        self.lastExecuted = None
+        self.__burstEnd = None
+
+    def currentRate(self, event):
+        """the maxRate for event, depending on the age of the burst"""
+        result = self.maxRate
+        held = event.when - self.burstStart
+        for seconds, rate in self.accelerate:
+            if held >= datetime.timedelta(seconds=seconds):
+                result = rate
+        return result
+
+    def admit(self, trigger, event):
+        """should trigger execute event now?"""
+        if self.lastEvent is None or event.when - self.lastEvent.when > datetime.timedelta(seconds=self.quiet):
+            self.burstStart = event.when
+            self.lastExecuted = None
+        self.lastEvent = event
+        if self.trailing:
+            if self.__burstEnd and self.__burstEnd.active():
+                self.__burstEnd.reset(self.quiet)
+            else:
+                self.__burstEnd = reactor.callLater(self.quiet, self.__burstEnded, trigger)
+        if self.lastExecuted is None:
+            result = self.leading
+        else:
+            rate = self.currentRate(event)
+            if rate is None:
+                result = True
+            elif rate == 0:
+                result = False
+            else:
+                result = event.when - self.lastExecuted.when >= datetime.timedelta(seconds=1.0 / rate)
+        if result:
+            self.lastExecuted = event
+        return result
+
+    def __burstEnded(self, trigger):
+        """nothing happened for quiet seconds"""
+        self.__burstEnd = None
+        if self.lastEvent is not self.lastExecuted:
+            self.lastExecuted = self.lastEvent
+            trigger.dispatch(self.lastEvent)
+
+def datetimeToSeconds(when):
+    """a datetime as seconds since the epoch"""
+    return time.mktime(when.timetuple()) + when.microsecond / 1000000.0
+
+def messageClass(name):
+    """the Message subclass with this name, for events coming
+    from other processes"""
+    todo = [Message]
+    while todo:
+        cls = todo.pop()
+        if cls.__name__ == name:
+            return cls
+        todo.extend(cls.__subclasses__())
+    raise KeyError('unknown message class {}'.format(name))
+
+def dumpEvent(event):
+    """returns (class name, decoded, seconds since epoch) for passing
+    an event to another process"""
+    return event.__class__.__name__, event.decoded, datetimeToSeconds(event.when)
+
+def loadEvent(className, decoded, when):
+    """the reverse of dumpEvent. The event keeps its original time"""
+    result = messageClass(className)(decoded)
+    result.when = datetime.datetime.fromtimestamp(when)
+    return result
+
 class Trigger(object):
     """a trigger always has a name. parts is a single event or a list of events.
        parts will be compared with the actual received events.
@@ -224,9 +472,20 @@ class Trigger(object):
                        look at following triggers
         mayRepeat      Default is False. If True, the trigger will not execute
                        if it is the last previously executed trigger
+        rate           Default is None. A RatePolicy deciding which events of
+                       a burst are executed. If given, mayRepeat is ignored.
+        priority       Default is None: the priority of the event, which is
+                       INTERACTIVE for remote controls.
+        deadline       Default is None. If given, requests of the action
+                       still waiting after so many seconds are cancelled.
+        group          Default is None. A new action of a trigger in the same
+                       supersession group cancels what the older action still
+                       has to do, and queued actions of the group are dropped.
+                       So only the latest intent is executed.
     """
     running = None
     queued = []
+    groups = {} # group: ActionContext of the latest action in group
     previousExecuted = None
     longRunCancellerStarted = False
 
@@ -244,6 +503,11 @@ class Trigger(object):
         self.maxTime = None
         self.stopIfMatch = False
         self.mayRepeat = False
+        self.rate = None
+        self.priority = None
+        self.deadline = None
+        self.group = None
+        self.context = None # of the latest execution
         if len(self.parts) > 1 and not self.maxTime:
             self.maxTime = datetime.timedelta(seconds=len(self.parts)-1)
         if not Trigger.longRunCancellerStarted:
@@ -263,11 +527,20 @@ class Trigger(object):
 
     def execute(self, event):
         """execute this trigger action"""
-        if not self.mayRepeat and id(self) == id(Trigger.previousExecuted):
+        if self.rate:
+            if not self.rate.admit(self, event):
+                return
+        elif not self.mayRepeat and id(self) == id(Trigger.previousExecuted):
             repeatMaxTime = datetime.timedelta(seconds=0.5)
             if event.when - Trigger.previousExecuted.event.when < repeatMaxTime:
                 return
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        """queue this trigger action for event"""
         logDebug(None, 'f', 'ACTION queue:{}'.format(str(self)))
+        if self.group:
+            self.supersede()
         self.event = event
         Trigger.queued.append(self)
         Trigger.previousExecuted = self
@@ -275,6 +548,16 @@ class Trigger(object):
             logDebug(None, None, 'When starting trigger {}, older trigger still runs:{}'.format(self, Trigger.running))
         self.run()
 
+    def supersede(self):
+        """we are the latest intent for our group"""
+        dropped = [x for x in Trigger.queued if x.group == self.group]
+        if dropped:
+            logDebug(None, 'f', 'ACTION superseded by {}: {}'.format(self, ' '.join(str(x) for x in dropped)))
+            Trigger.queued = [x for x in Trigger.queued if x.group != self.group]
+        older = Trigger.groups.get(self.group)
+        if older:
+            older.cancel('superseded by {}'.format(self))
+
     @staticmethod
     def run():
         """if no trigger action is currently running and we have some in the
@@ -285,26 +568,37 @@ class Trigger(object):
             trgr = Trigger.running = Trigger.queued.pop(0)
             assert trgr.action
             logDebug(None, 'f', 'ACTION start:{}'.format(str(trgr)))
-            act = trgr.action(trgr.event, *trgr.args, **trgr.kwargs)
+            priority = trgr.event.priority if trgr.priority is None else trgr.priority
+            context = trgr.context = ActionContext(priority, trgr.action.__name__, trgr.deadline)
+            if trgr.group:
+                Trigger.groups[trgr.group] = context
+            act = ActionContext.call(context, trgr.action, trgr.event, *trgr.args, **trgr.kwargs)
             assert act, 'Trigger {} returns None'.format(str(trgr))
-            return act.addCallback(trgr.executed).addErrback(trgr.notExecuted)
+            return act.addCallback(trgr.executed, context).addErrback(trgr.notExecuted, context)
 
-    def executed(self, dummyResult):
-        """now the trigger has finished. TODO: error path"""
+    def executed(self, dummyResult, context):
+        """now the trigger has finished"""
         logDebug(None, 'f', 'ACTION done :{} '.format(self))
+        context.done()
         Trigger.running = None
         self.run()
 
-    def notExecuted(self, result):
-        """now the trigger has finished. TODO: error path"""
-        LOGGER.error('ACTION {} had error :{}'.format((self, str(result))))
+    def notExecuted(self, result, context):
+        """now the trigger has finished with an error. A cancelled action
+        only ends itself, other errors also drop the queued triggers"""
+        context.done()
+        if result.check(CancelledError):
+            logDebug(None, 'f', 'ACTION {} cancelled: {}'.format(self, result.getErrorMessage()))
+        else:
+            LOGGER.error('ACTION {} had error :{}'.format(self, str(result)))
+            Trigger.queued = []
         Trigger.running = None
-        Trigger.queued = []
         self.run()
 
     @classmethod
     def cancelLongRun(cls):
-        """after 10 seconds, cancel a running request"""
+        """after 10 seconds, let the next trigger run. The old
+        action goes on unless its own deadline cancels it"""
         if cls.running:
             elapsed = elapsedSince(cls.running.event.when)
             logDebug(None, 't', '{} running since {} seconds'.format(
@@ -330,22 +624,79 @@ class Trigger(object):
 
 class Hal(object):
     """base class for central definitions, to be overridden by you!"""
+    configPath = None # the file defining our class, set by main()
+    # callables getting the Hal after setup() and before the reactor runs
+    startHooks = []
+    # True while reload() executes the configuration file. Older
+    # configurations call main() unconditionally, main() ignores that
+    reloading = False
+
     def __init__(self):
         self.triggers = []
         self.events = []
+        self.maxEvents = 100 # we only need as many as the longest trigger has parts
         self.timers = []
+        self.devices = {} # see SerializerMeta
         self.__timerInterval = 20
+        self.eventForwarders = [] # callables getting all events from our own devices
         self.setup()
+        for hook in self.startHooks:
+            hook(self)
+        signal.signal(signal.SIGHUP, self.__sighup)
         reactor.callLater(0, self.__checkTimers)
         reactor.run()
 
     def setup(self):
         """override this, not __init__"""
 
-    def eventReceived(self, event):
-        """central entry point for all events"""
+    def __sighup(self, dummySignum, dummyFrame):
+        """kill -HUP reloads the configuration"""
+        reactor.callFromThread(self.reload)
+
+    def reload(self, dummyEvent=None):
+        """re-read the file defining our class and rebuild triggers and
+        timers with its setup(). Devices constructed with the same
+        arguments as before are reused, keeping their connections, task
+        queues and state, see SerializerMeta. Attributes initialised in
+        __init__ of the new class are not set. Triggered by SIGHUP, but
+        this can also be used as a trigger action."""
+        path = self.configPath or sys.modules[self.__class__.__module__].__file__
+        if path.endswith('.pyc') or path.endswith('.pyo'):
+            path = path[:-1]
+        namespace = {'__name__': 'halirc_reload', '__file__': path}
+        oldClass, oldTriggers, oldTimers = self.__class__, self.triggers, self.timers
+        try:
+            Hal.reloading = True
+            try:
+                execfile(path, namespace)
+            finally:
+                Hal.reloading = False
+            self.__class__ = namespace[oldClass.__name__]
+            self.triggers = []
+            self.timers = []
+            self.setup()
+        except Exception: # pylint: disable=W0703
+            LOGGER.exception('reloading {} failed, keeping the old configuration'.format(path))
+            self.__class__, self.triggers, self.timers = oldClass, oldTriggers, oldTimers
+            return succeed(None)
+        lastDone = dict((x.key(), x.lastDone) for x in oldTimers)
+        for timer in self.timers:
+            timer.lastDone = lastDone.get(timer.key())
+        LOGGER.info('reloaded {}: {} triggers, {} timers, {} devices'.format(
+            path, len(self.triggers), len(self.timers), len(self.devices)))
+        return succeed(None)
+
+    def eventReceived(self, event, remote=False):
+        """central entry point for all events. Events from our own
+        devices are also passed to all eventForwarders, remote events
+        come from other processes and are not forwarded again."""
+        if not remote:
+            for forwarder in self.eventForwarders:
+                forwarder(event)
         triggers = list()
         self.events.append(event)
+        if len(self.events) > self.maxEvents:
+            del self.events[:-self.maxEvents // 2]
         matchingTriggers = list(x for x in self.triggers if x.matches(self.events))
         for trgr in matchingTriggers:
             if trgr.matches(self.events):
@@ -353,11 +704,12 @@ class Hal(object):
                 trgr.execute(event)
                 if trgr.stopIfMatch:
                     break
-        if triggers:
-            for trgr in triggers:
-                logDebug(None, 'e', 'received {}, triggers {}'.format(event, trgr))
-        else:
-            logDebug(None, 'e', 'received {}, triggers nothing'.format(event))
+        if isDebugging('e'):
+            if triggers:
+                for trgr in triggers:
+                    logDebug(None, 'e', 'received {}, triggers {}'.format(event, trgr))
+            else:
+                logDebug(None, 'e', 'received {}, triggers nothing'.format(event))
 
     def addTrigger(self, source, msg, action, *args, **kwargs):
         """a little helper for a common use case"""
@@ -399,13 +751,20 @@ class Request(Deferred):
         self.createTime = datetime.datetime.now()
         self.sendTime = None
         self.answerTime = datetime.datetime.now() if maxWaitSeconds == -1 else None
+        self.isProbe = False # probes may fail without disturbing others
+        self.context = ActionContext.current
+        self.priority = ActionContext.priorityOf(self.context)
+        if self.context:
+            self.context.requests.add(self)
+        self.delayedAfter = None # we had to wait for the delay after this request
+        self.__delayCall = None
         assert isinstance(message, Message), message
         Deferred.__init__(self)
 
     def restOfDelay(self, oldRequest):
         """the remaining time of the delay between oldRequest and self"""
         if oldRequest:
-            delay = self.protocol.delay(oldRequest, self)
+            delay = self.protocol.requestDelay(oldRequest, self)
             if delay:
                 elapsed = elapsedSince(oldRequest.sendTime)
                 stillWaiting = delay - elapsed
@@ -422,8 +781,10 @@ class Request(Deferred):
         harmless, we cannot simply respect delay to previous command,
         we need to check further back in the history"""
         if not self.protocol.connected:
+            if self.context and self.context.cancelled:
+                return succeed(None) # send() drops us
             logDebug('delay Sending for 0.1 second, we are not connected', 't', self.message)
-            return sleep(0.1).addCallback(self.__delaySending)
+            return self.__wait(0.1).addCallback(self.__delaySending)
         allRequests = [x for x in self.protocol.tasks.allRequests if x.sendTime]
         # sometimes we must wait even if the previous command has been
         # acked. Needed for LGTV after poweron.
@@ -431,23 +792,39 @@ class Request(Deferred):
             waitingAfter = sorted(allRequests, key=self.restOfDelay)[-1]
             stillWaiting = self.restOfDelay(waitingAfter)
             if stillWaiting:
+                self.delayedAfter = waitingAfter
                 logDebug(self.protocol, 't', 'sleeping {} out of {} seconds between {} and {}'.format(
-                    stillWaiting, self.protocol.delay(waitingAfter, self), waitingAfter.message, self.message))
-                deferred = Deferred()
-                reactor.callLater(stillWaiting, deferred.callback, None)
-                return deferred
+                    stillWaiting, self.protocol.requestDelay(waitingAfter, self), waitingAfter.message, self.message))
+                return self.__wait(stillWaiting)
         return succeed(None)
 
+    def __wait(self, seconds):
+        """returns a Deferred firing after seconds or after wakeUp()"""
+        deferred = Deferred()
+        self.__delayCall = reactor.callLater(seconds, deferred.callback, None)
+        return deferred
+
+    def wakeUp(self):
+        """stop waiting for the delay, send() finds out why"""
+        if self.__delayCall and self.__delayCall.active():
+            self.__delayCall.reset(0)
+
     def send(self):
         """send request to device"""
         def send1(dummyResult):
             """now the transport is open"""
+            if self.context and self.context.cancelled:
+                # cancelled while waiting for the delay
+                self.protocol.tasks.cancelRunning(self)
+                return
             self.sendTime = datetime.datetime.now()
             data = self.message.encoded + self.protocol.eol
             logDebug(self.protocol, 'p', 'WRITE {}: {}'.format(self, repr(data)))
             return self.protocol.write(data)
         def sent(dummy, sendDeferred):
             """off it went"""
+            if self.called:
+                return
             Trigger.running = None
             if self.maxWaitSeconds > 0:
                 reactor.callLater(self.maxWaitSeconds, timedout, sendDeferred)
@@ -455,10 +832,14 @@ class Request(Deferred):
             """did we time out?"""
             if self.answerTime:
                 return
-            LOGGER.error('Timeout on {}, cancelling'.format(self))
+            if self.isProbe:
+                logDebug(self.protocol, 't', 'Timeout on probe {}'.format(self))
+            else:
+                LOGGER.error('Timeout on {}, cancelling'.format(self))
             timedoutDeferred.cancel()
-            Trigger.running = None
-            Trigger.queued = []
+            if not self.isProbe and self.context:
+                # the rest of this action would only find a confused device
+                self.context.cancel('timeout on {}'.format(self))
             self.errback(Exception('request timed out: {}'.format(self)))
         sendDeferred = self.protocol.open()
         sendDeferred.addCallback(self.__delaySending).addCallback(send1).addCallback(sent, sendDeferred)
@@ -467,12 +848,22 @@ class Request(Deferred):
         return sendDeferred
 
     def callback(self, *args, **kwargs):
-        """request fulfilled"""
-        Deferred.callback(self, *args, **kwargs)
+        """request fulfilled. What the callbacks do belongs to our context"""
+        if self.context:
+            self.context.requests.discard(self)
+        ActionContext.call(self.context, Deferred.callback, self, *args, **kwargs)
+
+    def errback(self, *args, **kwargs):
+        """request failed"""
+        if self.context:
+            self.context.requests.discard(self)
+        ActionContext.call(self.context, Deferred.errback, self, *args, **kwargs)
 
     def _donotwait(self, dummyResult):
         """do callback(None) and log warning"""
         assert self.maxWaitSeconds == -1, "_donotwait: maxWaitSeconds {} should be -1".format(self.maxWaitSeconds)
+        if self.called:
+            return
         Trigger.running = None
         self.callback(None)
 
@@ -490,6 +881,59 @@ class Request(Deferred):
                 id(self) % 10000, self.protocol.name(), self.message,
                 comment, 'nowait' if self.maxWaitSeconds == -1 else self.maxWaitSeconds)
 
+class RequestQueue(object):
+    """the waiting requests of a TaskQueue, one FIFO per priority class.
+    Interactive requests always go first. A background request waiting
+    longer than maxWait is overdue and goes before normal requests, but
+    only one at a time: after it, normal requests get their turn again,
+    so background work is never starved and never floods. Since the
+    TaskQueue only takes the next request when the running one is done,
+    a new interactive request preempts queued background work."""
+    maxWait = 10 # seconds for BACKGROUND
+
+    def __init__(self):
+        self.queues = list(deque() for _ in (INTERACTIVE, NORMAL, BACKGROUND))
+        self.__lifted = False # the last pop was an overdue background request
+
+    def append(self, request):
+        """queue request in its class"""
+        self.queues[request.priority].append(request)
+
+    def pop(self):
+        """the next request to run"""
+        interactive, normal, background = self.queues
+        if interactive:
+            return interactive.popleft()
+        if background and not (normal and self.__lifted):
+            if not normal or elapsedSince(background[0].createTime) > self.maxWait:
+                self.__lifted = bool(normal)
+                return background.popleft()
+        if normal:
+            self.__lifted = False
+            return normal.popleft()
+        raise IndexError('pop from empty RequestQueue')
+
+    def remove(self, request):
+        """if request is queued, remove it"""
+        try:
+            self.queues[request.priority].remove(request)
+        except ValueError:
+            pass
+
+    def clear(self):
+        """forget all"""
+        for queue in self.queues:
+            queue.clear()
+
+    def __len__(self):
+        return sum(len(x) for x in self.queues)
+
+    def __iter__(self):
+        """by priority"""
+        for queue in self.queues:
+            for request in queue:
+                yield request
+
 class TaskQueue(object):
     """serializes requests for a device. If needed, delay next
     request. Problem: We should do this at a higher level. For
@@ -501,15 +945,20 @@ class TaskQueue(object):
     def __init__(self, device):
         self.device = device
         self.running = None
-        self.queued = []
+        self.queued = RequestQueue()
         self.allRequests = []
 
     def push(self, request):
         """put a task into the queue and try to run it"""
         assert isinstance(request, Request), request
+        if request.context and request.context.cancelled:
+            request.addErrback(self.failed)
+            request.errback(CancelledError('{}: {}'.format(request.context, request.context.cancelled)))
+            return request
         request.previous = self.allRequests[-1] if self.allRequests else None
         self.queued.append(request)
-        logDebug(self.device, 'c', 'queued for {}: {}'.format(self.device, request))
+        logDebug(self.device, 'c', 'queued for {} with priority {}: {}'.format(
+            self.device, request.priority, request))
         self.allRequests = self.allRequests[-20:]
         self.allRequests.append(request)
         request.addErrback(self.failed)
@@ -517,11 +966,38 @@ class TaskQueue(object):
         return request
 
     def failed(self, result):
-        """a request failed. Clear the queue."""
-        LOGGER.error('Request {} failed with` {}, clearing queue for {}'.format(
-            id(self) % 10000, result, self.running.protocol.name()))
+        """a request failed. Cancel the action it belongs to, or if there is
+        none, clear the queue. A failing probe only fires with None and lets
+        the queue continue. Cancelled requests pass the CancelledError on,
+        ending their action."""
+        if result.check(CancelledError):
+            return result
+        if self.running and self.running.isProbe:
+            probe = self.running
+            self.running = None
+            if not probe.called:
+                probe.callback(None)
+            self.run()
+            return
+        running = self.running
         self.running = None
-        self.queued = []
+        if running is None:
+            # the request did not get as far as running, like when open() failed
+            LOGGER.error('Request for {} failed with {}'.format(self.device.name(), result))
+        else:
+            self.device.delayOutcome(running, False)
+            if running.context:
+                LOGGER.error('Request {} failed with {}, cancelling {}'.format(
+                    id(running) % 10000, result, running.context))
+                running.context.cancel(result.getErrorMessage())
+            else:
+                LOGGER.error('Request {} failed with {}, clearing queue for {}'.format(
+                    id(running) % 10000, result, self.device.name()))
+                dropped = list(self.queued)
+                self.queued.clear()
+                for request in dropped:
+                    request.errback(CancelledError('queue cleared after {}'.format(result)))
+        reactor.callLater(0, self.run)
 
     def run(self):
         """if no task is active and we have pending tasks,
@@ -531,27 +1007,216 @@ class TaskQueue(object):
             self.running = None
             reactor.callLater(0, self.run) # do not call directly, no recursion
         if not self.running and self.queued:
-            self.running = self.queued.pop(0)
+            self.running = self.queued.pop()
             if self.running.maxWaitSeconds == -1:
                 return self.running.send().addCallback(sent).addErrback(self.failed)
             else:
                 return self.running.send().addErrback(self.failed)
 
+    def cancelRunning(self, request):
+        """request was cancelled before it could be sent"""
+        if self.running is request:
+            self.running = None
+            reactor.callLater(0, self.run)
+        request.errback(CancelledError('{}: {}'.format(request.context, request.context.cancelled)))
+
     def gotAnswer(self, msg):
         """the device returned an answer"""
         logDebug(self.device, 'r', 'gotAnswer for {}: {}'.format(self.running, msg))
         self.running.answerTime = datetime.datetime.now()
         running = self.running
+        self.device.remember(msg, running.message.humanCommand())
+        self.device.delayOutcome(running, msg.status == 'OK')
         self.running = None
         running.callback(msg)
         self.run()
 
 def sleep(secs):
-    """returns a Deferred which fires after secs"""
+    """returns a Deferred which fires after secs, in the current ActionContext.
+    Cancelling the context errbacks it"""
     deferred = Deferred()
-    reactor.callLater(secs, deferred.callback, None)
+    context = ActionContext.current
+    def fire():
+        """secs have passed"""
+        if context:
+            context.sleeps.discard((delayedCall, deferred))
+        ActionContext.call(context, deferred.callback, None)
+    delayedCall = reactor.callLater(secs, fire)
+    if context:
+        context.sleeps.add((delayedCall, deferred))
     return deferred
 
+class Readiness(object):
+    """finds out when a device is ready for commands after it got power
+    or after a poweron command: after an initial wait, poll the cheap
+    question query with growing pauses until the answer is acceptable.
+    The time this took is remembered, and a low percentile of those
+    samples becomes the next initial wait. We never wait longer than
+    maxWait, which should be the old fixed worst case delay. If maxWait
+    is None, use the bootDelay of the device."""
+    # pylint: disable=R0913,R0902
+    maxSamples = 50
+    percentile = 20     # the initial wait is this percentile of the samples...
+    margin = 0.8        # ... multiplied with this
+    probeTimeout = 0.5
+    firstPause = 0.1    # pause between probes, doubling up to maxPause
+    maxPause = 1.0
+
+    def __init__(self, device, query, maxWait=None, minWait=0, accept=None):
+        self.device = device
+        self.query = query
+        self.__maxWait = maxWait
+        self.minWait = minWait
+        self.accept = accept or self.answered
+        self.samples = []
+        self.confirmed = None # when the device was last found ready
+
+    @staticmethod
+    def answered(answer):
+        """default for accept: any good answer is fine"""
+        return answer is not None and answer.status == 'OK'
+
+    def maxWait(self):
+        """never wait longer"""
+        return self.__maxWait if self.__maxWait is not None else self.device.bootDelay
+
+    def initialWait(self):
+        """how long to wait before the first probe"""
+        if len(self.samples) < 3:
+            return self.minWait
+        ordered = sorted(self.samples)
+        learned = ordered[len(ordered) * self.percentile // 100] * self.margin
+        return min(self.maxWait(), max(self.minWait, learned))
+
+    def confirmedSince(self, since):
+        """was the device found ready after since?"""
+        return bool(self.confirmed and since and self.confirmed > since)
+
+    def wait(self, dummyResult=None):
+        """returns a Deferred firing when the device is ready or
+        when maxWait has passed. It only errbacks if the action
+        waiting for it is cancelled."""
+        start = datetime.datetime.now()
+        result = Deferred()
+        def probe(dummyResult, pause):
+            """ask the device"""
+            if elapsedSince(start) >= self.maxWait():
+                logDebug(self.device, 't', '{} not ready after {} seconds, giving up'.format(
+                    self.device.name(), self.maxWait()))
+                result.callback(None)
+                return
+            request = Request(self.device, self.device.question(self.query),
+                maxWaitSeconds=self.probeTimeout)
+            request.isProbe = True
+            self.device.tasks.push(request).addCallbacks(gotAnswer, result.errback, callbackArgs=(pause, ))
+        def gotAnswer(answer, pause):
+            """is it ready?"""
+            if answer is not None and self.accept(answer):
+                elapsed = elapsedSince(start)
+                logDebug(self.device, 't', '{} ready after {:.3f} seconds'.format(self.device.name(), elapsed))
+                self.confirmed = datetime.datetime.now()
+                self.samples = self.samples[-self.maxSamples + 1:] + [elapsed]
+                result.callback(answer)
+            else:
+                sleep(pause).addCallbacks(probe, result.errback, callbackArgs=(min(pause * 2, self.maxPause), ))
+        sleep(self.initialWait()).addCallbacks(probe, result.errback, callbackArgs=(self.firstPause, ))
+        return result
+
+class AdaptiveDelay(object):
+    """learns how much of the hand tuned delay() a device really needs.
+    For every pair (previous command, next command) we keep a factor
+    applied to delay(). After healthyAnswers good answers in a row
+    it shrinks, never below minFactor. An error or a timeout doubles it,
+    up to maxFactor. Only requests which really had to wait teach
+    something. Commands in exempt, like power commands handled
+    by Readiness, always get the full delay."""
+    # pylint: disable=R0913
+    minFactor = 0.25
+    maxFactor = 2.0
+    shrink = 0.9
+    grow = 2.0
+    healthyAnswers = 5
+    slowAnswer = 2.0 # an answer slower than this many times the usual latency is no good sign
+
+    def __init__(self, device, exempt=(), minFactor=None, maxFactor=None):
+        self.device = device
+        self.exempt = exempt
+        if minFactor is not None:
+            self.minFactor = minFactor
+        if maxFactor is not None:
+            self.maxFactor = maxFactor
+        # key: [factor, good answers in a row, errors, answers, mean latency]
+        self.table = {}
+
+    @staticmethod
+    def key(previous, this):
+        """the pair as a string, questions end with ?"""
+        def cmd(request):
+            """one side"""
+            message = request.message
+            return message.humanCommand() + ('?' if message.isQuestion else '')
+        return '{}>{}'.format(cmd(previous), cmd(this))
+
+    def adjust(self, previous, this, delay):
+        """the delay we really use"""
+        if previous.message.humanCommand() in self.exempt:
+            return delay
+        entry = self.table.get(self.key(previous, this))
+        return delay * entry[0] if entry else delay
+
+    def learn(self, previous, this, success):
+        """this was sent after waiting for the delay after previous"""
+        if previous.message.humanCommand() in self.exempt:
+            return
+        key = self.key(previous, this)
+        entry = self.table.setdefault(key, [1.0, 0, 0, 0, None])
+        entry[3] += 1
+        latency = None
+        if success and this.sendTime and this.answerTime:
+            latency = elapsedSince(this.sendTime) - elapsedSince(this.answerTime)
+            if entry[4] is not None and latency > entry[4] * self.slowAnswer:
+                success = False
+        if success:
+            if latency is not None:
+                entry[4] = latency if entry[4] is None else entry[4] * 0.8 + latency * 0.2
+            entry[1] += 1
+            if entry[1] >= self.healthyAnswers:
+                entry[0] = max(self.minFactor, entry[0] * self.shrink)
+                entry[1] = 0
+        else:
+            entry[2] += 1
+            entry[1] = 0
+            entry[0] = min(self.maxFactor, entry[0] * self.grow)
+            LOGGER.info('{}: backing off after {}, delay factor for {} is now {:.2f}'.format(
+                self.device.name(), this.message, key, entry[0]))
+
+    def export(self):
+        """the learned table in readable form"""
+        return dict((x, {'factor': round(y[0], 3), 'errors': y[2], 'answers': y[3],
+            'latency': None if y[4] is None else round(y[4], 3)}) for x, y in self.table.items())
+
+class SerializerMeta(type):
+    """constructing a device which already exists for the same Hal
+    with the same class name and arguments returns the existing device. This lets
+    Hal.reload run setup() again without reconnecting anything.
+    Classes with arguments whose repr changes on every setup(), like
+    callables, define a staticmethod reuseKey(*args, **kwargs) returning
+    what identifies them, and reconfigure(*args, **kwargs) which is
+    called with the new arguments when reused."""
+    def __call__(cls, hal=None, *args, **kwargs):
+        devices = getattr(hal, 'devices', None)
+        if devices is None:
+            return type.__call__(cls, hal, *args, **kwargs)
+        if hasattr(cls, 'reuseKey'):
+            key = (cls.__name__, repr(cls.reuseKey(*args, **kwargs)))
+        else:
+            key = (cls.__name__, repr(args), repr(sorted(kwargs.items())))
+        if key not in devices:
+            devices[key] = type.__call__(cls, hal, *args, **kwargs)
+        elif hasattr(cls, 'reconfigure'):
+            devices[key].reconfigure(*args, **kwargs)
+        return devices[key]
+
 class Serializer(object):
     """
        a mixin class, presenting a unified interface
@@ -572,7 +1237,19 @@ class Serializer(object):
                         happens for volume changes done by halirc.
 
        outlet: None or a power outlet onto which this device is connected
+
+       readiness: None or a Readiness telling when the device is ready
+                  after its outlet switched power on. If None, wait
+                  bootDelay seconds.
+
+       dependencies: other devices which must be powered on before this one
+                     and may only be powered off after this one. Only
+                     PowerSequencer looks at them.
+
+       state: a cache holding the last known message for every command,
+              filled by answers and by events sent from the device
     """
+    __metaclass__ = SerializerMeta
     eol = '\r'
     message = Message
     debugIds = list()
@@ -581,6 +1258,16 @@ class Serializer(object):
     # just in case we use weakrefs anyway
     __instances = []
     poweronCommands = []
+    # for DeviceProxy: a line greeting new clients, and the command
+    # with which clients end their session
+    proxyGreeting = None
+    proxyQuit = None
+    # questions which are safe to ask at any time, for verifying the state
+    statusCommands = ()
+    # attributes which survive a restart, see snapshot.py
+    stateAttributes = ()
+    # speculate() trusts cached values younger than this many seconds
+    predictionAge = 300
 
     def __init__(self, hal, outlet=None):
         self.hal = hal
@@ -591,6 +1278,10 @@ class Serializer(object):
         self.bootDelay = 1     # time needed for cold boot
         self.shutdownDelay = 1 # time needed for shutdown into standby
         self.connected = True
+        self.state = {}
+        self.dependencies = []
+        self.readiness = None
+        self.adaptiveDelay = None # opt in with AdaptiveDelay(self)
 
     def open(self): # pylint: disable=R0201
         """the device is always open"""
@@ -601,6 +1292,30 @@ class Serializer(object):
         """compute necessary delay before we can execute request"""
         return 0
 
+    def requestDelay(self, previous, this):
+        """delay(), adjusted by what adaptiveDelay learned"""
+        result = self.delay(previous, this)
+        if self.adaptiveDelay and result:
+            result = self.adaptiveDelay.adjust(previous, this, result)
+        return result
+
+    def delayOutcome(self, request, success):
+        """tell adaptiveDelay how request did after waiting"""
+        if self.adaptiveDelay and request.delayedAfter and not request.isProbe:
+            self.adaptiveDelay.learn(request.delayedAfter, request, success)
+        request.delayedAfter = None
+
+    def learnDelays(self, exempt=()):
+        """opt in to AdaptiveDelay. Calling this again, like
+        Hal.reload does, keeps what has been learned"""
+        if not self.adaptiveDelay:
+            self.adaptiveDelay = AdaptiveDelay(self)
+        self.adaptiveDelay.exempt = exempt
+
+    def learnedDelays(self):
+        """for inspection, see AdaptiveDelay.export"""
+        return self.adaptiveDelay.export() if self.adaptiveDelay else {}
+
     def write(self, data):
         """default is writing to transport"""
         self.transport.write(data) # pylint: disable=E1101
@@ -609,22 +1324,157 @@ class Serializer(object):
 
     def defaultInputHandler(self, data):
         """we got a line from a device"""
-        logDebug(self, 'p', 'READ {}: {}'.format(self.name(), repr(data)))
+        if isDebugging('p'):
+            logDebug(self, 'p', 'READ {}: {}'.format(self.name(), repr(data)))
         msg = self.message(encoded=data)
+        msg.source = self
         isAnswer = self.tasks.running and \
             self.tasks.running.message.answerMatches(msg)
         if isAnswer:
             self.tasks.gotAnswer(msg)
+        else:
+            self.remember(msg)
         if not isAnswer or self.answersAsEvents:
             self.hal.eventReceived(msg)
         return msg
 
+    def remember(self, msg, command=None):
+        """put msg into the state cache. command defaults to the
+        command of msg, for answers it is the command we asked for"""
+        if msg.status == 'OK':
+            self.state[command or msg.humanCommand()] = msg
+
+    def saveState(self):
+        """returns what we want to keep over a restart, as plain data"""
+        def plain(value):
+            """datetime is not plain"""
+            if isinstance(value, datetime.datetime):
+                return {'datetime': datetimeToSeconds(value)}
+            return value
+        return {
+            'attributes': dict((x, plain(getattr(self, x))) for x in self.stateAttributes),
+            'state': dict((x, dumpEvent(y)) for x, y in self.state.items()),
+            'readiness': dict((x, y.samples) for x, y in vars(self).items() if isinstance(y, Readiness)),
+            'delays': self.adaptiveDelay.table if self.adaptiveDelay else {}}
+
+    def restoreState(self, data):
+        """the reverse of saveState. Restored messages are marked stale"""
+        def unplain(value):
+            """back to datetime"""
+            if isinstance(value, dict) and 'datetime' in value:
+                return datetime.datetime.fromtimestamp(value['datetime'])
+            return value
+        for name, value in data.get('attributes', {}).items():
+            if name in self.stateAttributes:
+                setattr(self, name, unplain(value))
+        for command, dumped in data.get('state', {}).items():
+            if command not in self.state:
+                try:
+                    msg = loadEvent(*dumped)
+                except Exception as exc: # pylint: disable=W0703
+                    LOGGER.error('{}: cannot restore {}: {}'.format(self.name(), dumped, exc))
+                    continue
+                msg.stale = True
+                self.state[command] = msg
+        for name, samples in data.get('readiness', {}).items():
+            readiness = getattr(self, name, None)
+            if isinstance(readiness, Readiness):
+                readiness.samples = list(samples)
+        if self.adaptiveDelay:
+            self.adaptiveDelay.table.update(data.get('delays', {}))
+
+    def staleCommands(self):
+        """statusCommands with a stale or no value in the state cache"""
+        return [x for x in self.statusCommands if x not in self.state or self.state[x].stale]
+
+    def cacheKey(self, command):
+        """the key into self.state for command"""
+        return self.message(command).humanCommand()
+
+    def queryMany(self, commands):
+        """ask the device for several values. Returns a Deferred
+        firing with a dict command:value, value is None if the device
+        did not answer. The default asks one by one, devices with a
+        faster way should override this."""
+        result = {}
+        def got(answer, command):
+            """one more value"""
+            result[command] = answer.value() if answer else None
+        def done(dummyResult):
+            """all values are there"""
+            return result
+        deferred = succeed(None)
+        for command in commands:
+            deferred.addCallback(self.ask, command).addCallback(got, command)
+        return deferred.addCallback(done)
+
+    def predict(self, command):
+        """the cached answer for command if it is fresh enough
+        to build on, else None"""
+        msg = self.state.get(self.cacheKey(command))
+        if msg is None or msg.stale or elapsedSince(msg.when) > self.predictionAge:
+            return None
+        return msg
+
+    def __askEach(self, questions):
+        """returns a Deferred firing with the list of answers"""
+        answers = []
+        deferred = succeed(None)
+        for question in questions:
+            deferred.addCallback(self.ask, question).addCallback(answers.append)
+        return deferred.addCallback(lambda dummy: answers)
+
+    def speculate(self, questions, action, verify=None, rollback=None):
+        """optimistic execution for toggles. action(*answers) computes
+        the new values from the answers to questions and sends them.
+
+        If the state cache predicts all answers, action runs at once and
+        only costs its own writes. Afterwards the questions in verify
+        (default: all) are asked again in the background. They should be
+        those the action does not change, like the power state. If an
+        answer differs from its prediction or the device rejects the write,
+        rollback() undoes what action changed in our attributes and action
+        runs again with real answers.
+
+        Without predictions, the questions are asked first."""
+        predicted = [self.predict(x) for x in questions]
+        if any(x is None for x in predicted):
+            return self.__askEach(questions).addCallback(lambda answers: action(*answers))
+        if verify is None:
+            verify = questions
+        def correct(reason):
+            """the prediction was wrong"""
+            LOGGER.info('{}: prediction failed ({}), correcting'.format(self.name(), reason))
+            if rollback:
+                rollback()
+            return self.__askEach(questions).addCallback(lambda answers: action(*answers))
+        def check(answers):
+            """compare with the predictions"""
+            expected = dict((x, y) for x, y in zip(questions, predicted) if x in verify)
+            for question, answer in zip(verify, answers):
+                if answer is None or answer.value() != expected[question].value():
+                    return correct('{} is {}'.format(question, answer.value() if answer else None))
+        def confirm(result):
+            """action is done, check in the background"""
+            if isinstance(result, Message) and result.status != 'OK':
+                correct(result.status)
+            elif verify:
+                self.__askEach(verify).addCallback(check).addErrback(LOGGER.error)
+            return result
+        logDebug(self, 'f', '{}: speculating on {}'.format(self.name(), predicted))
+        return action(*predicted).addCallback(confirm)
+
     def push(self, *args):
         """unconditionally send cmd"""
         _, msg = self.args2message(*args)
         assert isinstance(msg, Message), msg
         return self.tasks.push(Request(self, msg))
 
+    def passThrough(self, msg):
+        """send msg from a DeviceProxy client, returns a Deferred
+        firing with the answer"""
+        return self.push(msg)
+
     def pushBlind(self, *args):
         """unconditionally send cmd, do not expect an answer"""
         _, msg = self.args2message(*args)
@@ -647,6 +1497,10 @@ class Serializer(object):
             msg = self.message(msg)
         return event, msg
 
+    def question(self, command):
+        """returns a Message asking for the value of command"""
+        return self.message(self.message(command).humanCommand())
+
     def ask(self, *args):
         """ask the device for a value"""
         _, msg = self.args2message(*args)
@@ -659,12 +1513,19 @@ class Serializer(object):
         def hasPower(*dummyArgs):
             """device should have power"""
             # pylint: disable=W0142
-            return sleep(self.bootDelay).addCallback(self._poweron, *args)
+            return self.waitBooted().addCallback(self._poweron, *args)
         if self.outlet:
             return self.outlet.poweron(*args).addBoth(hasPower)
         else:
             return self._poweron(*args)
 
+    def waitBooted(self):
+        """returns a Deferred firing when the device should accept
+        commands after its outlet switched power on"""
+        if self.readiness:
+            return self.readiness.wait()
+        return sleep(self.bootDelay)
+
     def standby(self, *args):
         """put into standby mode"""
         def isOff(*dummyArgs):
@@ -723,73 +1584,459 @@ class Serializer(object):
                 for request in serializer.tasks.queued:
                     LOGGER.debug('open: {}'.format(request))
 
-class OsdCat(object):
-    """lets us display OSD messages on the X server"""
-    def __init__(self):
+def queryAll(queries):
+    """queries is a list of (device, commands). All devices are queried
+    in parallel, each of them with its fastest queryMany. Returns a Deferred
+    firing with a dict device:{command:value}"""
+    def gotAll(results):
+        """combine the single results"""
+        for (device, _), (success, values) in zip(queries, results):
+            if not success:
+                LOGGER.error('{}: query failed: {}'.format(device.name(), values.getErrorMessage()))
+        return dict((device, values if success else {})
+            for (device, _), (success, values) in zip(queries, results))
+    return DeferredList([x.queryMany(y) for x, y in queries], consumeErrors=True).addCallback(gotAll)
+
+class PowerSequencer(object):
+    """powers a group of devices on and off in the order given by their
+    dependencies: a device needs its outlet and its dependencies. This
+    forms a graph and independent branches are handled in parallel, so
+    bootDelay and shutdownDelay of different devices overlap. Switching
+    everything takes the time of the longest chain, not the sum of all
+    delays. Both poweron and standby can be used as trigger actions."""
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+
+    @staticmethod
+    def needs(node):
+        """the nodes which must be on before node"""
+        if not isinstance(node, Serializer):
+            return [] # an outlet
+        result = list(node.dependencies)
+        if node.outlet:
+            result.insert(0, node.outlet)
+        return result
+
+    def users(self):
+        """returns a dict node:nodes needing node, for all nodes
+        reachable from self.devices"""
+        result = {}
+        def visit(node, path):
+            """depth first, detecting cycles"""
+            if node in path:
+                raise Exception('power dependency cycle: {}'.format(
+                    ' -> '.join(str(x) for x in path + (node, ))))
+            if node in result:
+                return
+            result[node] = []
+            for need in self.needs(node):
+                visit(need, path + (node, ))
+        for device in self.devices:
+            visit(device, ())
+        for node in result:
+            for need in self.needs(node):
+                result[need].append(node)
+        return result
+
+    @staticmethod
+    def __targets(args):
+        """as a trigger action, the event comes first"""
+        if args and (args[0] is None or isinstance(args[0], Message)):
+            return args[1:]
+        return args
+
+    def poweron(self, *targets):
+        """power on targets and everything they need. Without targets,
+        power on all devices"""
+        targets = self.__targets(targets)
+        users = self.users()
+        started = {}
+        def start(node):
+            """returns a Deferred firing when node is on"""
+            if node not in started:
+                needed = DeferredList([start(x) for x in self.needs(node)], consumeErrors=True)
+                started[node] = needed.addCallback(self.__nodeOn, node)
+            return started[node]
+        for target in targets or self.devices:
+            assert target in users, '{} is not managed by this PowerSequencer'.format(target)
+            start(target)
+        return DeferredList(started.values(), consumeErrors=True)
+
+    def standby(self, *targets):
+        """power off targets and everything needing them. Outlets are
+        only switched off if all of their users are switched off.
+        Without targets, power off all devices and outlets"""
+        targets = self.__targets(targets)
+        users = self.users()
+        offNodes = set()
+        def addWithUsers(node):
+            """node and all its users must go"""
+            if node not in offNodes:
+                offNodes.add(node)
+                for user in users[node]:
+                    addWithUsers(user)
+        for target in targets or self.devices:
+            assert target in users, '{} is not managed by this PowerSequencer'.format(target)
+            addWithUsers(target)
+        for node in users:
+            if not isinstance(node, Serializer) and users[node]:
+                if all(x in offNodes for x in users[node]):
+                    offNodes.add(node)
+        stopped = {}
+        def stop(node):
+            """returns a Deferred firing when node is off"""
+            if node not in stopped:
+                waitFor = [stop(x) for x in users[node] if x in offNodes]
+                stopped[node] = DeferredList(waitFor, consumeErrors=True).addCallback(self.__nodeOff, node)
+            return stopped[node]
+        for node in offNodes:
+            stop(node)
+        return DeferredList(stopped.values(), consumeErrors=True)
+
+    @staticmethod
+    def __nodeOn(dummyResult, node):
+        """everything node needs is on"""
+        logDebug(None, 'f', 'PowerSequencer: powering on {}'.format(node))
+        if not isinstance(node, Serializer):
+            return node.poweron()
+        if node.outlet:
+            return node.waitBooted().addCallback(node._poweron) # pylint: disable=W0212
+        return node._poweron() # pylint: disable=W0212
+
+    @staticmethod
+    def __nodeOff(dummyResult, node):
+        """everything needing node is off"""
+        def isOff(dummyResult):
+            """give the device time to shut down before its outlet goes"""
+            return sleep(node.shutdownDelay)
+        logDebug(None, 'f', 'PowerSequencer: powering off {}'.format(node))
+        if not isinstance(node, Serializer):
+            return node.standby()
+        result = node._standby() # pylint: disable=W0212
+        if node.outlet:
+            result.addBoth(isOff)
+        return result
+
+class ManagedProcess(ProcessProtocol):
+    """an external program running under the reactor, so waiting
+    for it never blocks. args[0] is searched in PATH. Debug
+    output is shown if it is enabled for the owner, a device"""
+    killTimeout = 5 # after terminate, SIGKILL follows
+
+    def __init__(self, args, env=None, owner=None):
+        self.args = args
+        self.env = env
+        self.owner = owner
+        self.exitCode = None
+        self.__waiting = []
+        self.__kill = None
+
+    def __str__(self):
+        return '{}[{}]'.format(self.args[0], self.pid())
+
+    def start(self):
+        """returns self for chaining"""
+        reactor.spawnProcess(self, self.args[0], args=self.args, env=self.env or os.environ)
+        logDebug(self.owner, 'p', 'started process {}'.format(self))
+        return self
+
+    def pid(self):
+        """None if not running"""
+        return self.transport.pid if self.transport else None
+
+    def running(self):
+        """has it been started and not ended yet?"""
+        return self.pid() is not None
+
+    def wait(self, timeout=None):
+        """returns a Deferred firing with the exit code. If the
+        process still runs after timeout, it fires with None"""
+        deferred = Deferred()
+        if not self.running():
+            deferred.callback(self.exitCode)
+            return deferred
+        self.__waiting.append(deferred)
+        if timeout is not None:
+            def expired():
+                """it still runs"""
+                if deferred in self.__waiting:
+                    self.__waiting.remove(deferred)
+                    deferred.callback(None)
+            reactor.callLater(timeout, expired)
+        return deferred
+
+    def signal(self, name):
+        """send a signal like 'TERM' if the process still runs"""
+        if self.running():
+            try:
+                self.transport.signalProcess(name)
+            except ProcessExitedAlready:
+                pass
+
+    def terminate(self, timeout=None):
+        """SIGTERM, and SIGKILL if it is still there after timeout
+        (default killTimeout). Returns a Deferred firing with the exit code"""
+        if self.running():
+            logDebug(self.owner, 'p', 'terminating process {}'.format(self))
+            self.signal('TERM')
+            if not self.__kill:
+                self.__kill = reactor.callLater(
+                    self.killTimeout if timeout is None else timeout, self.signal, 'KILL')
+        return self.wait()
+
+    def outReceived(self, data):
+        """only shown for debugging"""
+        logDebug(self.owner, 'p', 'READ from {}: {}'.format(self, repr(data)))
+
+    def errReceived(self, data):
+        """log what the program complains about"""
+        for line in data.rstrip().split('\n'):
+            LOGGER.error('{}: {}'.format(self.args[0], line))
+
+    def processExited(self, reason):
+        """do not wait for children still holding our pipes"""
+        self.exitCode = getattr(reason.value, 'exitCode', None)
+        logDebug(self.owner, 'p', '{} ended: {}'.format(self.args[0], reason.getErrorMessage()))
+        if self.__kill and self.__kill.active():
+            self.__kill.cancel()
+        self.__kill = None
+        waiting, self.__waiting = self.__waiting, []
+        for deferred in waiting:
+            deferred.callback(self.exitCode)
+
+def runProcess(args, env=None, timeout=None, owner=None):
+    """run an external program. Returns a Deferred firing with its
+    exit code. If it runs longer than timeout, it is terminated"""
+    process = ManagedProcess(args, env, owner).start()
+    if timeout is None:
+        return process.wait()
+    def waited(exitCode):
+        """terminate it if it is still running"""
+        if process.running():
+            LOGGER.error('{} did not finish within {} seconds'.format(process, timeout))
+            return process.terminate()
+        return exitCode
+    return process.wait(timeout).addCallback(waited)
+
+class OsdBackend(object):
+    """where OsdCat shows its messages. See osd.py for more backends"""
+    def show(self, data):
+        """display data now"""
+        raise NotImplementedError
+
+    def close(self):
+        """release what we hold"""
+
+    def __str__(self):
+        """identifies the backend for OsdCat.reuseKey"""
+        return self.__class__.__name__
+
+class OsdCatProtocol(ProcessProtocol):
+    """the osd_cat process"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def processEnded(self, reason):
+        """tell the backend"""
+        self.backend.processEnded(self, reason)
+
+class OsdCatProcess(OsdBackend):
+    """shows messages through osd_cat on the X server. The process lives
+    while messages come in. After closeTimeout idle seconds it is
+    closed, None keeps it running. If it dies it is respawned."""
+    respawnDelay = 1 # doubles while osd_cat keeps dying, up to maxRespawnDelay
+    maxRespawnDelay = 60
+    executable = '/usr/bin/osd_cat'
+    args = ['osd_cat', '--align=center', '--outline=5', '--lines=1', '--delay=2', '--offset=10',
+        '--font=-adobe-courier-bold-r-normal--*-640-*-*-*-*']
+
+    def __init__(self, closeTimeout=20):
+        self.closeTimeout = closeTimeout
         self.__osdcat = None
-        self.__lastSent = None
-        self.closeTimeout = 20
+        self.__pending = None # waiting for respawn
+        self.__idle = None
+        self.__respawn = None
+        self.__started = 0
+        self.__respawnDelay = self.respawnDelay
 
     def open(self):
         """start process if not running"""
         if not self.__osdcat:
-            self.__osdcat = ProcessProtocol()
-            reactor.spawnProcess(self.__osdcat, '/usr/bin/osd_cat', args=['osd_cat',
-               '--align=center', '--outline=5', '--lines=1', '--delay=2', '--offset=10',
-               '--font=-adobe-courier-bold-r-normal--*-640-*-*-*-*' \
-               ], env={'DISPLAY': ':0'})
+            self.__osdcat = OsdCatProtocol(self)
+            self.__started = time.time()
+            reactor.spawnProcess(self.__osdcat, self.executable, args=self.args, env={'DISPLAY': ':0'})
             logDebug(self, 'p', 'OsdCat started process')
-        reactor.callLater(self.closeTimeout, self.close)
+        self.__keepAlive()
+
+    def __keepAlive(self):
+        """restart the one idle timer"""
+        if self.closeTimeout is None:
+            return
+        if self.__idle and self.__idle.active():
+            self.__idle.reset(self.closeTimeout)
+        else:
+            self.__idle = reactor.callLater(self.closeTimeout, self.close)
 
     def close(self):
         """close the process"""
+        if self.__idle and self.__idle.active():
+            self.__idle.cancel()
+        self.__idle = None
+        self.__pending = None
         if self.__osdcat:
-            if elapsedSince(self.__lastSent) > self.closeTimeout - 1:
-                self.__osdcat.transport.closeStdin()
-                self.__osdcat = None
-                logDebug(self, 'p', 'OsdCat stopped process')
+            osdcat, self.__osdcat = self.__osdcat, None
+            osdcat.transport.closeStdin()
+            logDebug(self, 'p', 'OsdCat stopped process')
+
+    def processEnded(self, osdcat, reason):
+        """if osd_cat died while we need it, start it again"""
+        if osdcat is not self.__osdcat:
+            return # we closed it
+        self.__osdcat = None
+        if time.time() - self.__started > self.maxRespawnDelay:
+            # it ran long enough, this is no crash loop
+            self.__respawnDelay = self.respawnDelay
+        delay = self.__respawnDelay
+        self.__respawnDelay = min(delay * 2, self.maxRespawnDelay)
+        LOGGER.error('osd_cat ended: {}, restarting in {} seconds'.format(reason.getErrorMessage(), delay))
+        if not (self.__respawn and self.__respawn.active()):
+            self.__respawn = reactor.callLater(delay, self.respawn)
+
+    def respawn(self):
+        """restart osd_cat, unless we went idle meanwhile"""
+        if self.closeTimeout is not None and not (self.__idle and self.__idle.active()):
+            return
+        if not self.__osdcat:
+            self.open()
+            if self.__pending is not None:
+                self.show(self.__pending)
 
-    def write(self, data):
+    def show(self, data):
         """write to the osd_cat process"""
+        if self.__respawn and self.__respawn.active():
+            self.__pending = data # respawn() will show it
+            self.__keepAlive()
+            return
+        self.__pending = None
         self.open()
         logDebug(self, 'p', 'WRITE to OsdCat: {}'.format(repr(data)))
         self.__osdcat.transport.write(data + '\n')
-        self.__lastSent = datetime.datetime.now()
+
+    def __str__(self):
+        return 'OsdCat'
+
+class OsdCat(object):
+    """lets us display OSD messages, by default through osd_cat on the
+    X server, see OsdCatProcess. Messages coming faster than one per
+    frameInterval are coalesced, only the latest one is shown.
+    With a hal, reload() reuses the OsdCat and its backend like a device."""
+    __metaclass__ = SerializerMeta
+    frameInterval = 0.1
+
+    def __init__(self, hal=None, backend=None):
+        self.hal = hal
+        self.backend = backend or OsdCatProcess()
+        self.__pending = None
+        self.__lastWrite = 0
+        self.__flush = None
+
+    @staticmethod
+    def reuseKey(backend=None):
+        """backends are identified by their str()"""
+        return str(backend) if backend else 'OsdCatProcess'
+
+    def reconfigure(self, backend=None):
+        """reload created the backend again, we keep the old one"""
+        if backend is not None and backend is not self.backend:
+            backend.close()
+
+    def write(self, data):
+        """show data. Returns at once, the backend only gets
+        the latest data per frameInterval"""
+        self.__pending = data
+        if not (self.__flush and self.__flush.active()):
+            wait = self.__lastWrite + self.frameInterval - time.time()
+            if wait > 0:
+                self.__flush = reactor.callLater(wait, self.__writePending)
+            else:
+                self.__writePending()
         return succeed(None)
 
+    def __writePending(self):
+        """pass the latest data to the backend"""
+        data, self.__pending = self.__pending, None
+        self.__lastWrite = time.time()
+        try:
+            self.backend.show(data)
+        except Exception as exc: # pylint: disable=W0703
+            LOGGER.error('{}: cannot show {}: {}'.format(self.backend, repr(data), exc))
+
+    def close(self):
+        """close the backend"""
+        self.backend.close()
+
     def __str__(self):
         return 'OsdCat'
 
     def __repr__(self):
         return 'OsdCat'
 
-class SimpleTelnet(LineOnlyReceiver, Telnet):
-    """just what we normally need"""
-    # pylint: disable=R0904
-    # pylint finds too many public methods
-
+class FramedReceiver(Protocol):
+    """like LineOnlyReceiver but cheaper for devices sending floods of
+    short lines, like the Denon while the volume knob is turned.
+    The buffer is a bytearray, the delimiter search does not slice it,
+    every line is copied exactly once out of a memoryview and the
+    buffer is compacted only once per dataReceived."""
     delimiter = '\r\n'
-
-    def __init__(self):
-        Telnet.__init__(self)
+    MAX_LENGTH = 16384
+    __buffer = None
+
+    def dataReceived(self, data):
+        """split data into lines"""
+        buf = self.__buffer
+        if buf is None:
+            buf = self.__buffer = bytearray()
+        buf.extend(data)
+        delimiter = self.delimiter
+        delimiterLength = len(delimiter)
+        view = memoryview(buf)
+        start = 0
+        end = buf.find(delimiter)
+        while end >= 0:
+            line = view[start:end].tobytes()
+            start = end + delimiterLength
+            self.lineReceived(line)
+            end = buf.find(delimiter, start)
+        del view # a bytearray with exported views cannot be resized
+        if start:
+            del buf[:start]
+        if len(buf) > self.MAX_LENGTH:
+            del buf[:]
+            return self.lineLengthExceeded()
 
     def lineReceived(self, line):
         """must be overridden"""
 
-    def disableRemote(self, option):
-        """disable a remote option"""
-
-    def disableLocal(self, option):
-        """disable a local option"""
+    def lineLengthExceeded(self):
+        """got garbage without delimiter"""
+        LOGGER.error('{}: line length exceeded, dropped buffer'.format(self.__class__.__name__))
 
 def main(hal):
-    """it should not be necessary to ever adapt this"""
-    if OPTIONS.background:
+    """it should not be necessary to ever adapt this.
+    For several rooms, see rooms.main"""
+    if Hal.reloading:
+        return
+    bootstrap()
+    runHal(hal)
+
+def runHal(hal):
+    """run hal until the reactor stops. Needs bootstrap()"""
+    # remember this before DaemonContext changes the working directory
+    hal.configPath = os.path.abspath(sys.modules[hal.__module__].__file__)
+    if OPTIONS.background and not OPTIONS.room:
+        import daemon
         with daemon.DaemonContext():
             hal()
     else:
         hal()
-
-scanDeviceIds()
-parseOptions()
-initLogger()
@@ -18,12 +18,13 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
+import os, time
+
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.internet import reactor
-from twisted.internet.endpoints import UNIXClientEndpoint
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
 
-from lib import Message, Serializer, logDebug
+from lib import Message, Serializer, LOGGER, logDebug, isDebugging, INTERACTIVE
 
 class LircMessage(Message):
     """holds contents received from a remote control or sent with
@@ -32,14 +33,20 @@ class LircMessage(Message):
        without the first part with the raw code.
        The decoded format is remote.button.repeat where button
        and repeat can be omitted. Omitted button matches any button.
-       Omitted repeat defaults to '00'.
+       Omitted repeat defaults to '00'. Repeat * matches any repeat.
        If a part includes a dot, that part must be surrounded by
        double quotes. Double quotes are not allowed in a part.
        Allowed examples:
        AcerP1165.Up.01
+       AcerP1165.Up.*
        AcerP1165
        "My other remote".button
+       This runs for every frame lircd sends, so lines are split only once
+       into their fields. The decoded and encoded strings are only
+       built when needed.
     """
+    # somebody is waiting for the button press to take effect
+    priority = INTERACTIVE
 
     def __init__(self, decoded=None, encoded=None):
         self.raw = None
@@ -50,14 +57,14 @@ class LircMessage(Message):
 
     def decodedParts(self, decoded=None):
         """a generator returning the single parts without their optional quotes"""
-        rest = decoded or self._decoded
+        rest = decoded or self.decoded
         wantedParts = 3
         while len(rest):
             if rest[0] == '"':
                 quote2 = rest.index('"', 1)
                 yield rest[1:quote2]
                 wantedParts -= 1
-                rest = rest[quote2:]
+                rest = rest[quote2 + 1:]
                 if len(rest):
                     assert(rest[0] == '.'), decoded
                     rest = rest[1:]
@@ -82,77 +89,332 @@ class LircMessage(Message):
         """initialize all internal values"""
         if encoded is not None:
             assert '"' not in encoded, encoded
-            self.raw, self.repeat, self.button, self.remote = encoded.split(' ')
+            self.raw, self.repeat, button, remote = encoded.split(' ', 3)
+            # there are only a few of them, and comparing interned strings is fast
+            self.button = intern(button)
+            self.remote = intern(remote)
         else: # decoded
-            self._decoded = decoded
             self.remote, self.button, self.repeat = self.decodedParts(decoded)
-        parts = [self.remote, self.button, self.repeat]
-        self._decoded = '.'.join('"%s"' % x if '.' in x else x for x in parts)
-        self._encoded = ' '.join([self.repeat or '', self.button or '', self.remote])
+
+    @apply
+    def encoded(): # pylint: disable=E0202
+        """get message string in transport format"""
+        def fget(self):
+            # pylint: disable=W0212
+            if self._encoded is None:
+                self._encoded = ' '.join([self.repeat or '', self.button or '', self.remote])
+            return self._encoded
+        return property(**locals())
+
+    @apply
+    def decoded(): # pylint: disable=E0202
+        """get human readable message string"""
+        def fget(self):
+            # pylint: disable=W0212
+            if self._decoded is None:
+                parts = [self.remote, self.button, self.repeat]
+                self._decoded = '.'.join('"%s"' % x if '.' in x else x for x in parts)
+            return self._decoded
+        return property(**locals())
 
     def humanCommand(self):
         return self.decoded
 
     def __str__(self):
-        return self._decoded
+        return self.decoded
 
     def __eq__(self, other):
-        """are those messages equal?"""
+        """are those messages equal? Empty parts and * match anything"""
         if type(self) != type(other):
             return False
-        myParts = list(self.decodedParts())
-        otherParts = list(other.decodedParts())
-        for idx in range(0, min([len(myParts), len(otherParts)])):
-            myPart, otherPart = myParts[idx], otherParts[idx]
-            if myPart and otherPart and myPart != otherPart:
+        for myPart, otherPart in ((self.remote, other.remote), (self.button, other.button),
+                (self.repeat, other.repeat)):
+            if myPart and otherPart and myPart != otherPart and myPart != '*' and otherPart != '*':
                 return False
         return True
 
+class LircCommand(Message):
+    """a command for lircd like SEND_ONCE remote button. Both forms
+    are the same. Several commands separated by newlines are written
+    at once, the answer is complete when lircd replied to all of them.
+    For the answer, the status is the first error lircd returned."""
+
+    def _setAttributes(self, decoded, encoded):
+        """the raw lines are both decoded and encoded"""
+        self._decoded = self._encoded = decoded or encoded
+        self.lines = self._encoded.split('\n')
+
+    def humanCommand(self):
+        """the raw lines"""
+        return self._decoded
+
+    def value(self):
+        """there is none"""
+        return ''
+
+    def answerMatches(self, answer):
+        """lircd echoes the command"""
+        return answer.humanCommand() == self.lines[-1]
+
 class LircProtocol(LineOnlyReceiver):
-    """the protocol for receiving lines from the lircd socket"""
+    """the protocol for the lircd socket. Lines between BEGIN and END
+    are replies to our commands, all others are button events"""
     delimiter = '\n'
 
-    def __init__(self):
-        self.wrapper = None
+    def __init__(self, factory):
+        self.factory = factory
+        self.reply = None # lines of the reply being received
+
+    def connectionMade(self):
+        """tell the Lirc device"""
+        self.factory.lirc.connectionChanged()
+
+    def connectionLost(self, dummyReason=None):
+        """tell the Lirc device"""
+        self.factory.protocol = None
+        self.factory.lirc.connectionChanged()
 
     def lineReceived(self, data):
         """we got a raw line from the lirc socket"""
-        logDebug(self, 'p', 'READ from {}: {}'.format(self.wrapper.name(), repr(data)))
-        msg = self.wrapper.message(encoded=data)
-        self.wrapper.hal.eventReceived(msg)
+        if isDebugging('p'):
+            logDebug(self.factory.lirc, 'p', 'READ from {}: {}'.format(self.factory.path, repr(data)))
+        if self.reply is not None:
+            if data == 'END':
+                reply, self.reply = self.reply, None
+                self.factory.lirc.replyReceived(reply)
+            else:
+                self.reply.append(data)
+        elif data == 'BEGIN':
+            self.reply = []
+        else:
+            self.factory.lirc.received(data, self.factory.path)
+
+class LircFactory(ReconnectingClientFactory):
+    """one lircd socket. If lircd is not there or goes away,
+    try again with growing pauses"""
+    factor = 2
+    maxDelay = 30
+
+    def __init__(self, lirc, path):
+        self.lirc = lirc
+        self.path = path
+        self.failing = False
+        self.protocol = None
+
+    def buildProtocol(self, dummyAddr):
+        """connected to lircd"""
+        self.resetDelay()
+        if self.failing:
+            LOGGER.info('connected to lircd at {}'.format(self.path))
+            self.failing = False
+        self.protocol = LircProtocol(self)
+        return self.protocol
+
+    def clientConnectionFailed(self, connector, reason):
+        """log only the first failure"""
+        if not self.failing:
+            LOGGER.error('got no connection to lircd at {}: {}'.format(self.path, reason.getErrorMessage()))
+            self.failing = True
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        """log and reconnect"""
+        LOGGER.error('lost connection to lircd at {}: {}'.format(self.path, reason.getErrorMessage()))
+        self.failing = True
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
 class Lirc(Serializer):
-    """for now can only receive events from lirc"""
+    """receives events from lircd and sends IR codes through it.
+
+    device is the lircd socket or a list of them, for several receivers.
+    All of them deliver into one stream of events. If two receivers see
+    the same IR frame, only the first one gets through. We send through
+    the first socket.
+
+    send('remote.button') sends one IR code, macro() several of them
+    in one write. sendStart and sendStop are for holding a button.
+    The IR blaster needs sendGap seconds between codes, delays can add
+    more after specific buttons or remotes like {'TV.Power': 2}."""
     message = LircMessage
+    eol = '\n'
+    # the same frame from another receiver within so many seconds is a duplicate
+    dedupWindow = 0.08
+    sendGap = 0.1
 
     def __init__(self, hal, device='/var/run/lirc/lircd'):
-        """the default lirc socket to listen on is /var/run/lirc/lircd.
-        Change that by setting self.irwSocket in setup()"""
+        """the default lirc socket to listen on is /var/run/lirc/lircd"""
         Serializer.__init__(self, hal)
-        self.irwSocket = device
-        self.protocol = None
-        self.open()
-
-    def open(self):
-        """open the connection to the lircd socket"""
-        def gotProtocol(result):
-            """now we have a connection"""
-            self.protocol = result
-            self.protocol.wrapper = self
-            logDebug(self, None, 'got lirc protocol')
-        def gotNoProtocol(result):
-            """something went wrong"""
-            print "got no connection to lirc: %s" % result
-        point = UNIXClientEndpoint(reactor, self.irwSocket, timeout=2)
-        factory = ClientFactory()
-        factory.protocol = LircProtocol
-        point.connect(factory).addCallback(gotProtocol).addErrback(gotNoProtocol)
+        self.sockets = [device] if isinstance(device, basestring) else list(device)
+        self.factories = []
+        self.delays = {}
+        self.connected = False
+        self.__recent = {} # frame: (time, socket)
+        self.__replies = [] # replies for self.__repliesFor
+        self.__repliesFor = None
+        self.connect()
+
+    def connect(self):
+        """connect to all lircd sockets"""
+        for path in self.sockets:
+            factory = LircFactory(self, path)
+            self.factories.append(factory)
+            reactor.connectUNIX(path, factory, timeout=2)
+
+    def connectionChanged(self):
+        """we can only send while connected to the first socket"""
+        self.connected = bool(self.factories[0].protocol)
+
+    def received(self, data, path):
+        """a line from the lircd at path"""
+        msg = self.message(encoded=data)
+        if len(self.sockets) > 1 and self.isDuplicate(msg, path):
+            return
+        self.hal.eventReceived(msg)
+
+    def isDuplicate(self, msg, path):
+        """did another receiver just deliver the same frame?"""
+        now = time.time()
+        key = (msg.raw, msg.repeat, msg.button, msg.remote)
+        seen = self.__recent.get(key)
+        if seen and seen[1] != path and now - seen[0] < self.dedupWindow:
+            logDebug(self, 'p', 'dropping duplicate from {}: {}'.format(path, msg))
+            return True
+        if len(self.__recent) > 100:
+            self.__recent = dict((x, y) for x, y in self.__recent.items() if now - y[0] < self.dedupWindow)
+        self.__recent[key] = (now, path)
+        return False
+
+    def replyReceived(self, lines):
+        """lircd replied. lines are those between BEGIN and END:
+        the command, SUCCESS or ERROR, and optionally DATA with
+        the number of lines and the lines"""
+        if not lines or lines[0] == 'SIGHUP':
+            return
+        reply = LircCommand(encoded=lines[0])
+        if len(lines) < 2 or lines[1] != 'SUCCESS':
+            reply.status = ' '.join(lines[4:]) if 'DATA' in lines else 'ERROR'
+        running = self.tasks.running
+        if not running or not isinstance(running.message, LircCommand):
+            LOGGER.error('Lirc: unexpected reply {}'.format(lines))
+            return
+        if self.__repliesFor is not running:
+            # whatever we got before belongs to a request which timed out
+            self.__replies = []
+            self.__repliesFor = running
+        self.__replies.append(reply)
+        if len(self.__replies) < len(running.message.lines):
+            return
+        replies, self.__replies = self.__replies, []
+        failed = [x for x in replies if x.status != 'OK']
+        if failed:
+            LOGGER.error('lircd: {}: {}'.format(failed[0].humanCommand(), failed[0].status))
+            reply.status = failed[0].status
+        self.tasks.gotAnswer(reply)
+
+    def delay(self, previous, this):
+        """the IR blaster needs a pause between codes"""
+        if not isinstance(previous.message, LircCommand):
+            return 0
+        result = self.sendGap
+        for line in previous.message.lines:
+            parts = line.split()
+            if len(parts) >= 3:
+                for key in ('{}.{}'.format(parts[1], parts[2]), parts[1]):
+                    result = max(result, self.delays.get(key, 0))
+        return result
 
     def write(self, data):
-        """write to lirc not yet implemented"""
-        raise Exception('writing to lirc is not yet implemented')
+        """write to the first lircd socket"""
+        protocol = self.factories[0].protocol
+        if not protocol:
+            raise Exception('lirc.write: not connected to {}'.format(self.sockets[0]))
+        protocol.transport.write(data)
+
+    @staticmethod
+    def command(directive, code, count=None):
+        """returns a line for lircd. code is remote.button"""
+        code = code if isinstance(code, LircMessage) else LircMessage(code)
+        result = '{} {} {}'.format(directive, code.remote, code.button)
+        if count:
+            result += ' {}'.format(count)
+        return result
 
     def send(self, *args):
-        """write to lirc not yet implemented"""
-        raise Exception('writing to lirc is not yet implemented')
+        """send an IR code once. The last argument is remote.button,
+        it may be preceded by the triggering event"""
+        return self.push(LircCommand(self.command('SEND_ONCE', args[-1])))
+
+    def sendStart(self, *args):
+        """start repeating an IR code until sendStop"""
+        return self.push(LircCommand(self.command('SEND_START', args[-1])))
+
+    def sendStop(self, *args):
+        """stop repeating"""
+        return self.push(LircCommand(self.command('SEND_STOP', args[-1])))
+
+    def macro(self, dummyEvent, codes):
+        """send several IR codes in one write. lircd sends them one
+        after the other, so we do not add delays between them"""
+        return self.push(LircCommand('\n'.join(self.command('SEND_ONCE', x) for x in codes)))
+
+class FakeLircd(Factory):
+    """behaves like lircd for testing without IR hardware: replies to
+    SEND_ONCE, SEND_START and SEND_STOP for the buttons of remotes,
+    a dict remote:[button], and records what was sent in self.sent.
+    broadcast() sends a button event to all clients.
+
+        FakeLircd({'TV': ['Power', 'Mute']}).listen('/tmp/lircd')"""
+
+    def __init__(self, remotes):
+        self.remotes = remotes
+        self.sent = []
+        self.clients = []
+
+    def listen(self, path):
+        """start listening on the UNIX socket path"""
+        if os.path.exists(path):
+            os.remove(path)
+        return reactor.listenUNIX(path, self)
+
+    def buildProtocol(self, dummyAddr):
+        """a new client"""
+        return FakeLircdProtocol(self)
+
+    def broadcast(self, remote, button, repeat=0):
+        """like lircd does when it receives IR"""
+        for client in self.clients:
+            client.sendLine('{:016x} {:02x} {} {}'.format(0x37ff07bee, repeat, button, remote))
+
+    def reply(self, line):
+        """returns the reply lines for a command line"""
+        parts = line.split()
+        if len(parts) < 3 or parts[0] not in ('SEND_ONCE', 'SEND_START', 'SEND_STOP'):
+            error = 'unknown directive: "{}"'.format(parts[0] if parts else '')
+        elif parts[1] not in self.remotes:
+            error = 'unknown remote: "{}"'.format(parts[1])
+        elif parts[2] not in self.remotes[parts[1]]:
+            error = 'unknown command: "{}"'.format(parts[2])
+        else:
+            self.sent.append(line)
+            return ['BEGIN', line, 'SUCCESS', 'END']
+        return ['BEGIN', line, 'ERROR', 'DATA', '1', error, 'END']
+
+class FakeLircdProtocol(LineOnlyReceiver):
+    """one client of FakeLircd"""
+    delimiter = '\n'
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def connectionMade(self):
+        """broadcast() reaches us now"""
+        self.fake.clients.append(self)
+
+    def connectionLost(self, dummyReason=None):
+        """forget this client"""
+        self.fake.clients.remove(self)
 
+    def lineReceived(self, line):
+        """reply like lircd"""
+        for reply in self.fake.reply(line):
+            self.sendLine(reply)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+More backends for OsdCat, the default is OsdCatProcess in lib.py.
+
+OsdCat(self, PyOsd())         renders in our own process with pyosd,
+                              no process startup after idle periods
+OsdCat(self, SocketOsd(path)) sends lines to a long lived helper
+                              listening on the UNIX socket path
+OsdCat(self, FileOsd(path))   appends lines to a file, or with path None
+                              only keeps them in memory. For testing
+                              without a display.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import LineOnlyReceiver
+
+from lib import LOGGER, OsdBackend, logDebug
+
+try:
+    import pyosd # pylint: disable=F0401
+except ImportError:
+    pyosd = None
+
+class PyOsd(OsdBackend):
+    """renders through libxosd in our process"""
+    font = '-adobe-courier-bold-r-normal--*-640-*-*-*-*'
+
+    def __init__(self, timeout=2, offset=10, outline=5):
+        if pyosd is None:
+            raise Exception('PyOsd needs the python module pyosd')
+        self.osd = pyosd.osd(font=self.font, lines=1, timeout=timeout)
+        self.osd.set_align(pyosd.ALIGN_CENTER)
+        self.osd.set_pos(pyosd.POS_BOT)
+        self.osd.set_vertical_offset(offset)
+        self.osd.set_outline_offset(outline)
+
+    def show(self, data):
+        """display data"""
+        self.osd.display(data)
+
+    def __str__(self):
+        return 'PyOsd'
+
+class SocketOsdProtocol(LineOnlyReceiver):
+    """the connection to the helper"""
+    delimiter = '\n'
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connectionMade(self):
+        """remember the connection"""
+        self.factory.connection = self
+
+    def connectionLost(self, dummyReason=None):
+        """forget the connection"""
+        self.factory.connection = None
+
+    def lineReceived(self, line):
+        """the helper has nothing to say"""
+
+class SocketOsdFactory(ReconnectingClientFactory):
+    """keeps connecting to the helper"""
+    maxDelay = 10
+
+    def __init__(self):
+        self.connection = None
+
+    def buildProtocol(self, dummyAddr):
+        """connected to the helper"""
+        self.resetDelay()
+        return SocketOsdProtocol(self)
+
+class SocketOsd(OsdBackend):
+    """writes lines to a helper process listening on a UNIX socket.
+    The helper is started and restarted by somebody else, like systemd.
+    While it is not there, messages are dropped: showing them later
+    would only confuse."""
+
+    def __init__(self, path):
+        self.path = path
+        self.factory = SocketOsdFactory()
+        reactor.connectUNIX(path, self.factory)
+
+    def show(self, data):
+        """send data to the helper"""
+        if self.factory.connection:
+            self.factory.connection.sendLine(data)
+        else:
+            logDebug(None, 'p', 'SocketOsd: not connected to {}, dropping {}'.format(self.path, repr(data)))
+
+    def close(self):
+        """stop reconnecting and disconnect"""
+        self.factory.stopTrying()
+        if self.factory.connection:
+            self.factory.connection.transport.loseConnection()
+
+    def __str__(self):
+        return 'SocketOsd({})'.format(self.path)
+
+class FileOsd(OsdBackend):
+    """appends to a file, for tests and headless machines.
+    shown holds the last maxShown messages."""
+    maxShown = 100
+
+    def __init__(self, path=None):
+        self.path = path
+        self.shown = []
+
+    def show(self, data):
+        """remember data and write it to the file"""
+        self.shown = self.shown[-self.maxShown + 1:] + [data]
+        if self.path:
+            try:
+                with open(self.path, 'a') as osdFile:
+                    osdFile.write(data + '\n')
+            except IOError as exc:
+                LOGGER.error('FileOsd: cannot write {}: {}'.format(self.path, exc))
+
+    def __str__(self):
+        return 'FileOsd({})'.format(self.path)
@@ -24,7 +24,8 @@ from twisted.internet import reactor
 from twisted.internet.protocol import ClientFactory
 
 
-from lib import Serializer, SimpleTelnet, Message, LOGGER, logDebug
+from telnet import SimpleTelnet
+from lib import Serializer, Message, Readiness, LOGGER, logDebug
 
 class PioneerMessage(Message):
     """holds content of a message from or to Pioneer"""
@@ -69,12 +70,15 @@ class Pioneer(Serializer):
     # switching channel
     eol = '\r\n'
     message = PioneerMessage
+    statusCommands = ('?P', )
 
     def __init__(self, hal, host, port=8102, outlet=None):
         Serializer.__init__(self, hal, outlet)
         self.host = host
         self.port = port
         self.protocol = None
+        self.readiness = Readiness(self, '?P')
+        self.poweronReadiness = Readiness(self, '?P', maxWait=5, minWait=1, accept=self.isOn)
 
     def open(self):
         """open connection if not open"""
@@ -93,10 +97,17 @@ class Pioneer(Serializer):
         return point.connect(factory).addCallback(gotProtocol).addErrback(gotNoProtocol)
 
     @staticmethod
-    def delay(previous, dummyThis):
-        """do we need to wait before sending this command?"""
+    def isOn(answer):
+        """the Pioneer answers ?P with an error while it is off"""
+        return not answer.value().startswith('E')
+
+    def delay(self, previous, this):
+        """do we need to wait before sending this command?
+        After PN, poweronReadiness does the waiting."""
         cmd = previous.message.humanCommand() if previous else ''
         if cmd == 'PN':
+            if this.isProbe or self.poweronReadiness.confirmedSince(previous.sendTime):
+                return 0
             return 5
 
     def write(self, data):
@@ -113,7 +124,7 @@ class Pioneer(Serializer):
 
     def _poweron(self, *dummyArgs):
         """power on the Pioneer"""
-        return self.send('PN')
+        return self.send('PN').addCallback(self.poweronReadiness.wait)
 
     def _standby(self, *dummyArgs):
         """standby the Pioneer"""
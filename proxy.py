@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Devices like Yamaha, Vdr and Pioneer can only handle one client at a
+time. A DeviceProxy lets other programs share the connection halirc
+holds: it listens on a local port and speaks the protocol of the device.
+Commands from clients go into the TaskQueue of the device, the answer
+goes back to the client which sent the command, and events the
+device sends on its own are passed to all clients.
+
+In setup():
+
+    DeviceProxy(self, yamaha, 50000)
+"""
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+
+from lib import LOGGER, SerializerMeta, logDebug
+
+class ProxyProtocol(LineOnlyReceiver):
+    """one client"""
+    delimiter = '\n'
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def connectionMade(self):
+        """a new client"""
+        self.proxy.clients.append(self)
+        logDebug(self.proxy.device, 'p', '{} proxy: new client {}'.format(
+            self.proxy.device.name(), self.transport.getPeer()))
+        if self.proxy.device.proxyGreeting:
+            self.write(self.proxy.device.proxyGreeting)
+
+    def connectionLost(self, dummyReason=None):
+        """forget this client"""
+        if self in self.proxy.clients:
+            self.proxy.clients.remove(self)
+
+    def write(self, line):
+        """write a line in the format of the device"""
+        self.transport.write(line + self.proxy.device.eol)
+
+    def lineReceived(self, line):
+        """a command from the client"""
+        line = line.rstrip('\r')
+        if not line:
+            return
+        device = self.proxy.device
+        if device.proxyQuit and line.lower() == device.proxyQuit:
+            self.transport.loseConnection()
+            return
+        try:
+            msg = device.message(line)
+        except Exception as exc: # pylint: disable=W0703
+            LOGGER.error('{} proxy: cannot understand {}: {}'.format(device.name(), repr(line), exc))
+            return
+        device.passThrough(msg).addCallback(self.gotAnswer)
+
+    def gotAnswer(self, answer):
+        """route the answer back to this client"""
+        if answer is not None and self.connected:
+            self.write(answer.encoded)
+
+class DeviceProxy(Factory, object):
+    """listens on port for clients of device"""
+    __metaclass__ = SerializerMeta
+
+    def __init__(self, hal, device, port, interface='127.0.0.1'):
+        self.device = device
+        self.clients = []
+        hal.eventForwarders.append(self.eventReceived)
+        reactor.listenTCP(port, self, interface=interface)
+
+    def buildProtocol(self, dummyAddr):
+        """a new client"""
+        return ProxyProtocol(self)
+
+    def eventReceived(self, event):
+        """broadcast what the device sent on its own"""
+        if event.source is self.device and event.encoded:
+            for client in self.clients:
+                client.write(event.encoded)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Run several rooms from one host, each room being a Hal with its
+own devices in its own worker process. A stuck serial driver or a
+slow device in one room cannot delay another room, and the rooms
+use more than one CPU core. In myhalirc.py, instead of main(MyHal):
+
+    from rooms import main
+    main({'living': LivingHal, 'kitchen': KitchenHal})
+
+The supervisor process starts one worker per room and restarts it
+if it dies. Every worker passes the events of its devices to the
+supervisor which forwards them to all other rooms, so a trigger in
+one room can react to a remote control received in another room.
+"""
+
+import sys, os, json
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, ProcessProtocol, ReconnectingClientFactory
+from twisted.protocols.basic import LineOnlyReceiver
+
+import lib
+from lib import LOGGER, Hal, dumpEvent, loadEvent, logDebug, bootstrap, runHal
+
+class RoomProtocol(LineOnlyReceiver):
+    """one line per event: a JSON list [room, class name, decoded, time].
+    Used on both ends of the connection between worker and supervisor"""
+    delimiter = '\n'
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def connectionMade(self):
+        """tell the owner"""
+        self.owner.connected(self)
+
+    def connectionLost(self, dummyReason=None):
+        """tell the owner"""
+        self.owner.disconnected(self)
+
+    def lineReceived(self, line):
+        """decode the JSON list and pass it to the owner"""
+        try:
+            parts = json.loads(line)
+        except ValueError:
+            LOGGER.error('rooms: got garbage: {}'.format(repr(line)))
+            return
+        self.owner.lineReceived(self, line, parts)
+
+class RoomLink(ReconnectingClientFactory):
+    """the worker end: connects to the supervisor"""
+    maxDelay = 5
+
+    def __init__(self, room, socketPath):
+        self.room = room
+        self.socketPath = socketPath
+        self.hal = None
+        self.protocol = None
+
+    def start(self, hal):
+        """a Hal.startHooks entry"""
+        self.hal = hal
+        hal.eventForwarders.append(self.forward)
+        reactor.connectUNIX(self.socketPath, self)
+
+    def buildProtocol(self, dummyAddr):
+        """connected to the supervisor"""
+        self.resetDelay()
+        return RoomProtocol(self)
+
+    def connected(self, protocol):
+        """tell the supervisor who we are"""
+        self.protocol = protocol
+        protocol.sendLine(json.dumps([self.room]))
+
+    def disconnected(self, dummyProtocol):
+        """the supervisor is gone"""
+        self.protocol = None
+
+    def forward(self, event):
+        """pass an event of our own devices to the other rooms"""
+        if self.protocol:
+            self.protocol.sendLine(json.dumps([self.room] + list(dumpEvent(event))))
+
+    def lineReceived(self, dummyProtocol, dummyLine, parts):
+        """an event from another room"""
+        try:
+            event = loadEvent(*parts[1:])
+        except (KeyError, TypeError, AssertionError) as exc:
+            LOGGER.error('rooms: cannot load event {}: {}'.format(parts, exc))
+            return
+        logDebug(None, 'e', 'event {} from room {}'.format(event, parts[0]))
+        self.hal.eventReceived(event, remote=True)
+
+class Worker(ProcessProtocol):
+    """the supervisor end of a worker process"""
+    restartDelay = 5
+
+    def __init__(self, supervisor, room):
+        self.supervisor = supervisor
+        self.room = room
+        self.transport = None
+
+    def start(self):
+        """start the worker process"""
+        args = [sys.executable, self.supervisor.script] + self.supervisor.args + [
+            '--room', self.room, '--roomsocket', self.supervisor.socketPath]
+        reactor.spawnProcess(self, sys.executable, args=args, env=os.environ)
+        LOGGER.info('rooms: started worker for {}'.format(self.room))
+
+    def outReceived(self, data):
+        """log what the worker says"""
+        for line in data.rstrip().split('\n'):
+            LOGGER.info('{}: {}'.format(self.room, line))
+
+    def errReceived(self, data):
+        """log worker errors"""
+        for line in data.rstrip().split('\n'):
+            LOGGER.error('{}: {}'.format(self.room, line))
+
+    def processEnded(self, reason):
+        """restart unless we are shutting down"""
+        LOGGER.error('rooms: worker for {} ended: {}'.format(self.room, reason.getErrorMessage()))
+        self.transport = None
+        if not self.supervisor.stopping:
+            reactor.callLater(self.restartDelay, self.start)
+
+class Supervisor(Factory):
+    """starts the workers and forwards events between rooms"""
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.script = os.path.abspath(sys.argv[0])
+        self.args = list(sys.argv[1:])
+        self.socketPath = '/tmp/halirc-rooms-{}.socket'.format(os.getpid())
+        self.workers = dict((x, Worker(self, x)) for x in rooms)
+        self.protocols = {}
+        self.stopping = False
+
+    def buildProtocol(self, dummyAddr):
+        """a worker connected"""
+        return RoomProtocol(self)
+
+    def connected(self, protocol):
+        """we learn the room with the first line"""
+
+    def disconnected(self, protocol):
+        """a worker went away"""
+        for room, value in self.protocols.items():
+            if value is protocol:
+                del self.protocols[room]
+
+    def lineReceived(self, protocol, line, parts):
+        """register a worker or forward its event to all other rooms"""
+        room = parts[0]
+        if len(parts) == 1:
+            self.protocols[room] = protocol
+            return
+        for other, otherProtocol in self.protocols.items():
+            if other != room:
+                otherProtocol.sendLine(line)
+
+    def run(self):
+        """listen for the workers, start them and run until stopped"""
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        reactor.listenUNIX(self.socketPath, self)
+        for worker in self.workers.values():
+            reactor.callWhenRunning(worker.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        reactor.run()
+
+    def stop(self):
+        """terminate all workers"""
+        self.stopping = True
+        for worker in self.workers.values():
+            if worker.transport:
+                worker.transport.signalProcess('TERM')
+
+def main(rooms):
+    """use this instead of lib.main for several rooms"""
+    if Hal.reloading:
+        return
+    bootstrap()
+    hal = prepare(rooms)
+    if hal is not None:
+        runHal(hal)
+
+def prepare(rooms):
+    """called by main. In a worker, returns the Hal class for
+    its room. In the supervisor, runs the supervisor and returns None"""
+    for room, hal in rooms.items():
+        assert issubclass(hal, Hal), '{}: {} is no Hal'.format(room, hal)
+    options = lib.OPTIONS
+    if options.room:
+        Hal.startHooks.append(RoomLink(options.room, options.roomSocket).start)
+        return rooms[options.room]
+    supervisor = Supervisor(rooms)
+    if options.background:
+        import daemon
+        with daemon.DaemonContext():
+            supervisor.run()
+    else:
+        supervisor.run()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+A local RPC server, so other programs like home automation front ends
+can use the devices through halirc instead of competing with it for
+devices which only accept one client. Everything goes through the
+TaskQueues of halirc.
+
+The server listens on a UNIX socket. Every request is one line of JSON,
+a single call or a batch of calls:
+
+    {"id": 1, "device": "Yamaha", "method": "ask", "args": ["@MAIN:VOL"]}
+    {"id": 2, "calls": [{"device": "Yamaha", "method": "queryMany",
+                         "args": [["@MAIN:PWR", "@MAIN:VOL"]]},
+                        {"device": "LGTV", "method": "send", "args": ["aspect:scan"]}]}
+    {"id": 3, "method": "reload"}
+
+and gets one line of JSON back, with one result per call:
+
+    {"id": 2, "results": [{"result": {"@MAIN:PWR": "On", ...}}, {"error": "..."}]}
+
+Calls for the same device are executed in the given order, calls for
+different devices in parallel. Messages are returned in their decoded
+form. Devices are named by Serializer.name() unless they have an
+attribute rpcName.
+
+In setup():
+
+    RpcServer(self, '/var/run/halirc/rpc.socket')
+"""
+
+import os, json
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, succeed, maybeDeferred
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python.failure import Failure
+
+from lib import LOGGER, Message, Serializer, SerializerMeta, logDebug
+
+class RpcProtocol(LineOnlyReceiver):
+    """one client connection"""
+    delimiter = '\n'
+    MAX_LENGTH = 1000000
+
+    def __init__(self, server):
+        self.server = server
+
+    def lineReceived(self, line):
+        """one JSON request per line"""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a JSON object')
+        except ValueError as exc:
+            self.sendLine(json.dumps({'error': str(exc)}))
+            return
+        self.server.execute(request).addCallback(self.answer)
+
+    def answer(self, response):
+        """send the response unless the client is gone"""
+        if self.transport and self.connected:
+            self.sendLine(json.dumps(response))
+
+def fromJson(value):
+    """json gives us unicode, but we send bytes to the devices"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [fromJson(x) for x in value]
+    return value
+
+def jsonable(result):
+    """convert the result of a device method for json"""
+    if isinstance(result, Message):
+        return result.decoded
+    if isinstance(result, dict):
+        return dict((str(x), jsonable(y)) for x, y in result.items())
+    if isinstance(result, (list, tuple)):
+        return [jsonable(x) for x in result]
+    if result is None or isinstance(result, (basestring, int, long, float, bool)):
+        return result
+    return repr(result)
+
+class RpcServer(Factory, object):
+    """exposes the methods in `methods` of all devices of a Hal"""
+    __metaclass__ = SerializerMeta
+    methods = ('send', 'ask', 'poweron', 'standby', 'queryMany', 'learnedDelays')
+    callTimeout = 60 # if a device never answers, give up after so many seconds
+
+    def __init__(self, hal, path):
+        self.hal = hal
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        reactor.listenUNIX(path, self)
+
+    def buildProtocol(self, dummyAddr):
+        """a new client"""
+        return RpcProtocol(self)
+
+    def devices(self):
+        """a dict name:device"""
+        result = {}
+        for key in sorted(self.hal.devices):
+            device = self.hal.devices[key]
+            if isinstance(device, Serializer):
+                name = getattr(device, 'rpcName', None) or device.name()
+                if name in result:
+                    LOGGER.error('RpcServer: two devices named {}, set rpcName'.format(name))
+                result[name] = device
+        return result
+
+    def execute(self, request):
+        """returns a Deferred firing with the response"""
+        calls = request.get('calls', [request])
+        devices = self.devices()
+        results = [None] * len(calls)
+        chains = {}
+        for idx, call in enumerate(calls):
+            device = call.get('device')
+            chain = chains.get(device, succeed(None))
+            chains[device] = chain.addCallback(self.__call, idx, call, devices, results)
+        def done(dummyResult):
+            """all calls are done"""
+            return {'id': request.get('id'), 'results': results}
+        return DeferredList(chains.values()).addCallback(done)
+
+    def __call(self, dummyResult, idx, call, devices, results):
+        """execute one call and put its outcome into results[idx]"""
+        def gotResult(result):
+            """the call succeeded"""
+            results[idx] = {'result': jsonable(result)}
+        def gotError(failure):
+            """the call failed"""
+            results[idx] = {'error': failure.getErrorMessage()}
+        method = call.get('method')
+        args = call.get('args', [])
+        logDebug(None, 'f', 'RPC call {}'.format(call))
+        if method == 'reload' and call.get('device') is None:
+            target = self.hal.reload
+        elif call.get('device') not in devices:
+            results[idx] = {'error': 'unknown device {}'.format(call.get('device'))}
+            return
+        elif method not in self.methods:
+            results[idx] = {'error': 'method {} is not allowed'.format(method)}
+            return
+        else:
+            target = getattr(devices[call['device']], method)
+        if not isinstance(args, list):
+            args = [args]
+        args = fromJson(args)
+        return self.timeout(maybeDeferred(target, *args)).addCallbacks(gotResult, gotError)
+
+    def timeout(self, deferred):
+        """errback if deferred does not fire within callTimeout"""
+        result = Deferred()
+        def expired():
+            """the device did not answer"""
+            result.errback(Exception('no result after {} seconds'.format(self.callTimeout)))
+        def fired(value):
+            """in time?"""
+            if delayed.active():
+                delayed.cancel()
+                if isinstance(value, Failure):
+                    result.errback(value)
+                else:
+                    result.callback(value)
+        delayed = reactor.callLater(self.callTimeout, expired)
+        deferred.addBoth(fired)
+        return result
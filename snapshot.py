@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Snapshots of what halirc knows about the devices, so a restart starts
+warm: attributes like Yamaha.mutedVolume or Vdr.prevChannel, the state
+caches and the learned readiness times. The snapshot is written
+periodically and at shutdown. It is replaced atomically, so after a
+crash we find either the previous or the new snapshot.
+
+Restored values are marked stale. Triggers can use them at once, and
+some seconds after startup the stale statusCommands of every device
+are verified in the background.
+
+At the end of setup(), after creating all devices:
+
+    Snapshot(self)
+"""
+
+import os, json
+
+from twisted.internet import reactor
+
+import lib
+from lib import LOGGER, Serializer, SerializerMeta, stateFile, writeAtomic, logDebug, inBackground, queryAll
+
+class Snapshot(object):
+    """saves and restores the state of all devices of a Hal"""
+    __metaclass__ = SerializerMeta
+    interval = 300   # save every so many seconds
+    verifyDelay = 10 # verify restored values so many seconds after startup
+
+    def __init__(self, hal, path=None):
+        self.hal = hal
+        if path is None:
+            # every room worker has its own devices
+            room = lib.OPTIONS.room
+            path = stateFile('snapshot-%s.json' % room if room else 'snapshot.json')
+        self.path = path
+        self.restore()
+        reactor.callLater(self.verifyDelay, self.verify)
+        reactor.callLater(self.interval, self.periodic)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.save)
+
+    def devices(self):
+        """a dict id:device. The id stays the same over restarts
+        as long as the device is created with the same arguments"""
+        return dict((''.join(x), y) for x, y in self.hal.devices.items()
+            if isinstance(y, Serializer))
+
+    def save(self):
+        """write the snapshot"""
+        data = {}
+        for key, device in self.devices().items():
+            try:
+                data[key] = device.saveState()
+            except Exception as exc: # pylint: disable=W0703
+                LOGGER.error('Snapshot: cannot save {}: {}'.format(key, exc))
+        writeAtomic(self.path, json.dumps(data, separators=(',', ':')))
+        logDebug(None, 'f', 'Snapshot: saved {} devices to {}'.format(len(data), self.path))
+
+    def periodic(self):
+        """save regularly, we might crash"""
+        self.save()
+        reactor.callLater(self.interval, self.periodic)
+
+    def restore(self):
+        """read the snapshot and pass it to the devices"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as snapshotFile:
+                data = json.load(snapshotFile)
+        except ValueError as exc:
+            LOGGER.error('Snapshot: cannot read {}: {}'.format(self.path, exc))
+            return
+        for key, device in self.devices().items():
+            if key in data:
+                device.restoreState(toStr(data[key]))
+        logDebug(None, 'f', 'Snapshot: restored from {}'.format(self.path))
+
+    def verify(self):
+        """ask the devices for the values we only know from the snapshot"""
+        queries = list((x, x.staleCommands()) for x in self.devices().values())
+        queries = list(x for x in queries if x[1])
+        if queries:
+            # one batched exchange per device, all devices in parallel
+            inBackground(queryAll, queries)
+
+def toStr(value):
+    """json gives us unicode, the devices want str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [toStr(x) for x in value]
+    if isinstance(value, dict):
+        return dict((toStr(x), toStr(y)) for x, y in value.items())
+    return value
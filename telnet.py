@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+"""
+
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.conch.telnet import Telnet
+
+class SimpleTelnet(LineOnlyReceiver, Telnet):
+    """just what we normally need"""
+    # pylint: disable=R0904
+    # pylint finds too many public methods
+
+    delimiter = '\r\n'
+
+    def __init__(self):
+        Telnet.__init__(self)
+
+    def lineReceived(self, line):
+        """must be overridden"""
+
+    def disableRemote(self, option):
+        """disable a remote option"""
+
+    def disableLocal(self, option):
+        """disable a local option"""
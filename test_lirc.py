@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2011 Wolfgang Rohdewald <wolfgang@rohdewald.de>
+
+halirc is free software you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Lirc against FakeLircd, no IR hardware needed. Run with
+
+    trial test_lirc
+"""
+
+import os, tempfile
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+import lib
+from lirc import Lirc, LircMessage, FakeLircd
+
+class FakeHal(object):
+    """just enough of a Hal for one device"""
+    def __init__(self):
+        self.devices = {}
+        self.eventForwarders = []
+        self.events = []
+
+    def eventReceived(self, event, dummyRemote=False):
+        """remember the event"""
+        self.events.append(event)
+
+class LircTest(unittest.TestCase):
+    """send through and receive from FakeLircd"""
+
+    def setUp(self):
+        """start FakeLircd and connect a Lirc to it"""
+        lib.parseOptions([])
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'lircd')
+        self.fake = FakeLircd({'TV': ['Power', 'Mute']})
+        self.port = self.fake.listen(path)
+        self.hal = FakeHal()
+        self.lirc = Lirc(self.hal, path)
+        self.lirc.sendGap = 0
+        return self.waitFor(lambda: self.lirc.connected)
+
+    def tearDown(self):
+        """disconnect and forget the timeouts of answered requests"""
+        for factory in self.lirc.factories:
+            factory.stopTrying()
+            if factory.protocol:
+                factory.protocol.transport.loseConnection()
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+        return self.port.stopListening().addCallback(lambda x: os.rmdir(self.directory))
+
+    def waitFor(self, condition, seconds=2.0):
+        """returns a Deferred firing when condition() is true"""
+        if condition():
+            return deferLater(reactor, 0, lambda: None)
+        if seconds <= 0:
+            self.fail('condition never became true')
+        return deferLater(reactor, 0.01, lambda: None).addCallback(
+            lambda x: self.waitFor(condition, seconds - 0.01))
+
+    def testSend(self):
+        """lircd confirms the code"""
+        def sent(answer):
+            """SUCCESS"""
+            self.assertEqual(answer.status, 'OK')
+            self.assertEqual(self.fake.sent, ['SEND_ONCE TV Power'])
+        return self.lirc.send('TV.Power').addCallback(sent)
+
+    def testUnknownButton(self):
+        """lircd rejects a button the remote does not have"""
+        def sent(answer):
+            """ERROR"""
+            self.assertEqual(answer.status, 'unknown command: "Volume"')
+            self.assertEqual(self.fake.sent, [])
+        return self.lirc.send('TV.Volume').addCallback(sent)
+
+    def testMacro(self):
+        """several codes in one request"""
+        def sent(answer):
+            """one reply per code"""
+            self.assertEqual(answer.status, 'OK')
+            self.assertEqual(self.fake.sent, ['SEND_ONCE TV Power', 'SEND_ONCE TV Mute'])
+        return self.lirc.macro(None, ['TV.Power', 'TV.Mute']).addCallback(sent)
+
+    def testReceive(self):
+        """a button press becomes an event"""
+        def received(dummyResult):
+            """the event is a LircMessage"""
+            event = self.hal.events[0]
+            self.assertTrue(isinstance(event, LircMessage))
+            self.assertEqual((event.remote, event.button), ('TV', 'Mute'))
+        self.fake.broadcast('TV', 'Mute')
+        return self.waitFor(lambda: self.hal.events).addCallback(received)
@@ -19,7 +19,7 @@ along with this program if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 """
 
-import os, subprocess
+import os, re
 
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.internet.defer import Deferred, succeed
@@ -27,14 +27,19 @@ from twisted.internet import reactor
 from twisted.internet.protocol import ClientFactory
 
 
-from lib import Serializer, SimpleTelnet, Message, LOGGER, logDebug, elapsedSince
+from telnet import SimpleTelnet
+from lib import Serializer, Message, ManagedProcess, LOGGER, logDebug, elapsedSince, runProcess, sleep
 
 class VdrMessage(Message):
     """holds content of a message from or to Vdr"""
     def __init__(self, decoded=None, encoded=None):
         """for the VDR we only use the machine form, its
-        readability is acceptable"""
+        readability is acceptable. SVDRP reply codes 4xx and 5xx
+        are errors, we never remember them"""
         Message.__init__(self, decoded, encoded)
+        code = self._encoded.split(' ')[0]
+        if len(code) == 3 and code.isdigit() and code[0] in '45':
+            self.status = self._encoded
 
     def command(self):
         """the human readable command"""
@@ -81,6 +86,108 @@ class VdrProtocol(SimpleTelnet):
         else:
             LOGGER.error('vdr sent data without being asked:{}'.format(line))
 
+class VdrSyslog(object):
+    """follows what VDR writes into syslog and turns it into events.
+    inotify tells us when the file grows, so nothing is polled. If
+    inotify is not available or syslog is not readable, live stays
+    False and Vdr asks as before."""
+
+    vdrLine = re.compile(r'\svdr(?:\[\d+\])?: (?:\[\d+\] )?(.*)$')
+    # vdr 2.x: switching to channel 5 S19.2E-1-1019-10301 (ZDF)
+    channelSwitch = re.compile(r'^switching to channel (\d+)(?: \S+)?(?: \((.*)\))?$')
+    # timer 3 (5 2015-2115 'Tagesschau') start
+    timerAction = re.compile(r"^timer \d+ \(\d+ \d+-\d+ (?:VPS )?'(.*)'\) (start|stop)$")
+
+    def __init__(self, vdr, path='/var/log/syslog'):
+        self.vdr = vdr
+        self.path = path
+        self.live = False
+        self.file = None
+        self.partial = ''
+        self.notifier = None
+        self.modified = None # the inotify mask
+
+    def start(self):
+        """start following syslog from its current end"""
+        try:
+            from twisted.internet import inotify
+            from twisted.python.filepath import FilePath
+        except ImportError:
+            LOGGER.error('{}: no inotify, not following syslog'.format(self.vdr.name()))
+            return
+        if not self.reopen(end=True):
+            return
+        self.modified = inotify.IN_MODIFY
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        self.notifier.watch(FilePath(self.path), mask=self.modified, callbacks=[self.changed])
+        # logrotate moves the file away and syslog creates a new one
+        self.notifier.watch(FilePath(os.path.dirname(self.path)),
+            mask=inotify.IN_CREATE | inotify.IN_MOVED_TO, callbacks=[self.created])
+        self.live = True
+
+    def stop(self):
+        """stop following syslog"""
+        if self.notifier:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.live = False
+
+    def reopen(self, end=False):
+        """open syslog, returns success"""
+        if self.file:
+            self.file.close()
+        try:
+            self.file = open(self.path)
+        except IOError as exc:
+            LOGGER.error('{}: cannot follow syslog: {}'.format(self.vdr.name(), exc))
+            self.file = None
+            self.live = False
+            return False
+        if end:
+            self.file.seek(0, os.SEEK_END)
+        self.partial = ''
+        return True
+
+    def changed(self, dummyWatch, dummyPath, dummyMask):
+        """syslog has grown"""
+        data = self.partial + self.file.read()
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.lineReceived(line)
+
+    def created(self, dummyWatch, path, dummyMask):
+        """after logrotate, the watch on the file follows the old one"""
+        if path.basename() != os.path.basename(self.path):
+            return
+        if self.file:
+            self.changed(None, None, None)
+        try:
+            self.notifier.ignore(path)
+        except KeyError:
+            pass # the kernel already dropped it
+        if self.reopen():
+            self.notifier.watch(path, mask=self.modified, callbacks=[self.changed])
+            self.changed(None, None, None)
+
+    def lineReceived(self, line):
+        """one line from syslog, most of them are not from vdr"""
+        match = self.vdrLine.search(line)
+        if not match:
+            return
+        text = match.group(1)
+        match = self.channelSwitch.match(text)
+        if match:
+            self.vdr.eventReceived('chan {} {}'.format(match.group(1), match.group(2) or '').strip())
+            return
+        match = self.timerAction.match(text)
+        if match:
+            self.vdr.recordingChanged(match.group(1), match.group(2) == 'start')
+
 class Vdr(Serializer):
 
     """talks to VDR. This is a wrapper around the Telnet protocol
@@ -88,10 +195,13 @@ class Vdr(Serializer):
     some timeout and automatically reopen it when needed. Vdr
     can only handle one client simultaneously."""
 
-    # TODO: an event generator watching syslog for things like
-    # switching channel
     eol = '\r\n'
     message = VdrMessage
+    proxyGreeting = '220 halirc SVDRP proxy'
+    proxyQuit = 'quit'
+    kodiTimeout = 5 # seconds kodi gets for quitting before we kill it
+    statusCommands = ('chan', )
+    stateAttributes = ('prevChannel', )
 
     def __init__(self, hal, host='localhost', port=6419):
         Serializer.__init__(self, hal)
@@ -102,6 +212,42 @@ class Vdr(Serializer):
         self.prevChannel = None
         self.closeTimeout = 5
         self.kodiProcess = None
+        self.syslog = None
+        self.recordings = set()
+
+    def followSyslog(self, path='/var/log/syslog'):
+        """get channel switches and recordings as events from syslog.
+        They also keep the state cache current, so we need not ask
+        for the channel anymore"""
+        if self.syslog and self.syslog.path == path:
+            return # after reload
+        if self.syslog:
+            self.syslog.stop()
+        self.syslog = VdrSyslog(self, path)
+        self.syslog.start()
+
+    def eventReceived(self, decoded):
+        """something happened in vdr without us asking"""
+        msg = self.message(decoded)
+        msg.source = self
+        self.remember(msg)
+        self.hal.eventReceived(msg)
+
+    def recordingChanged(self, title, started):
+        """a timer started or stopped recording"""
+        if started:
+            self.recordings.add(title)
+        else:
+            self.recordings.discard(title)
+        self.eventReceived('recording {} {}'.format('start' if started else 'stop', title))
+
+    def suspendChanged(self, suspended):
+        """we know what softhddevice does now"""
+        mode = 'SUSPEND_NORMAL' if suspended else 'NOT_SUSPENDED'
+        self.remember(self.message('910 SuspendMode: {}'.format(mode)), self.cacheKey('plug softhddevice stat'))
+        msg = self.message('suspend {}'.format('on' if suspended else 'off'))
+        msg.source = self
+        self.hal.eventReceived(msg)
 
     def open(self):
         """open connection if not open"""
@@ -141,14 +287,18 @@ class Vdr(Serializer):
         return self.push(msg)
 
     def getChannel(self, dummyResult=None):
-        """returns current channel number and name"""
+        """returns current channel number and name. While we follow
+        syslog, the state cache knows them"""
         def got(result):
             """we got the current channel"""
             result = result.decoded.split(' ')
-            if result[0] != '250':
+            if result[0] not in ('250', 'chan'):
                 return None, None
             else:
                 return result[1], ' '.join(result[2:])
+        cached = self.state.get('chan')
+        if self.syslog and self.syslog.live and cached and not cached.stale:
+            return succeed(got(cached))
         return self.push(self.message('chan')).addCallback(got)
 
     def gotoChannel(self, dummyResult, channel):
@@ -172,26 +322,47 @@ class Vdr(Serializer):
             environ = dict(os.environ)
             environ['DISPLAY'] = ':0'
             environ['HOME'] = '/home/wr'
-            self.kodiProcess = subprocess.Popen(["kodi", "-fs"], env=environ)
-            logDebug(self, None, 'started kodi process {}'.format(self.kodiProcess.pid))
+            self.kodiProcess = ManagedProcess(['kodi', '-fs'], env=environ, owner=self).start()
+            self.kodiProcess.wait().addCallback(kodiEnded, self.kodiProcess)
+        def kodiEnded(dummyExitCode, process):
+            """also if the user quits kodi"""
+            if self.kodiProcess is process:
+                self.kodiProcess = None
+        def stopKodi():
+            """kodi is a script waiting for kodi.bin. Ask kodi.bin to
+            quit and kill what is left after kodiTimeout"""
+            process, self.kodiProcess = self.kodiProcess, None
+            def waitQuit(dummyResult):
+                """the script ends with kodi.bin"""
+                if process:
+                    return process.wait(self.kodiTimeout)
+                return sleep(self.kodiTimeout)
+            def kill(dummyResult):
+                """whatever still runs"""
+                if process and process.running():
+                    LOGGER.error('kodi did not quit within {} seconds, killing it'.format(self.kodiTimeout))
+                    process.terminate(0)
+                return runProcess(['killall', '-q', '-9', 'kodi.bin'], owner=self)
+            return runProcess(['killall', '-q', 'kodi.bin'], owner=self).addCallback(waitQuit).addCallback(kill)
         def _remoteOff(dummyResult):
             """disable remote control"""
+            self.suspendChanged(True)
             return self.send('remo off')
+        def _resume():
+            """resume softhddevice"""
+            return self.send('plug softhddevice resu').addCallback(lambda dummy: self.suspendChanged(False))
         def _toggle1(result):
             """result ends in NOT_SUSPENDED or SUSPEND_NORMAL"""
             if result.value().endswith(' NOT_SUSPENDED'):
                 return self.send('plug softhddevice susp').addCallback(_remoteOff).addCallback(startKodi)
             elif result.value().endswith(' SUSPEND_NORMAL'):
-                if self.kodiProcess:
-                    logDebug(self, None, 'killing kodi process {}'.format(self.kodiProcess.pid))
-                    self.kodiProcess.kill() # would be nice to terminate cleanly
-                    _ = self.kodiProcess.wait()
-                    self.kodiProcess = None
-                subprocess.Popen(['killall', '-9', 'kodi.bin']).wait()
-                reactor.callLater(7, self.send, 'plug softhddevice resu')
+                stopKodi().addErrback(LOGGER.error)
+                reactor.callLater(7, _resume)
                 return self.send('remo on')
             else:
                 LOGGER.error('plug softhddevice stat returns unexpected answer:{}'.format(repr(result)))
                 return succeed(None)
 
+        # always ask: softhddevice can also be switched by other means
+        # and nothing tells us about that
         return self.ask('plug softhddevice stat').addCallback(_toggle1)
@@ -25,7 +25,8 @@ from twisted.internet.protocol import ClientFactory
 from twisted.internet.defer import succeed
 
 
-from lib import Serializer, SimpleTelnet, Message, logDebug, elapsedSince
+from telnet import SimpleTelnet
+from lib import Serializer, Message, Readiness, logDebug, elapsedSince
 
 class YamahaMessage(Message):
     """holds content of a message from or to Yamaha"""
@@ -84,6 +85,12 @@ class Yamaha(Serializer):
     # switching channel
     eol = '\r\n'
     message = YamahaMessage
+    statusCommands = ('@MAIN:PWR', '@MAIN:VOL', '@MAIN:MUTE', '@MAIN:INP')
+    stateAttributes = ('mutedVolume', )
+    # those zones answer @ZONE:BASIC=? with their basic status lines
+    bulkZones = ('@MAIN', '@ZONE2', '@ZONE3', '@ZONE4')
+    # answered after the bulk lines, and never part of them
+    bulkBarrier = '@SYS:MODELNAME'
 
     def __init__(self, hal, host, port=50000, outlet=None):
         Serializer.__init__(self, hal, outlet)
@@ -93,6 +100,7 @@ class Yamaha(Serializer):
         self.mutedVolume = None
         self.answersAsEvent = True
         self.closeTimeout = 2000000
+        self.readiness = Readiness(self, '@MAIN:PWR')
         self.open()
 
     def open(self):
@@ -153,12 +161,54 @@ class Yamaha(Serializer):
         else:
             return self.pushBlind(msg)
 
+    def question(self, command):
+        """the Yamaha asks with =?"""
+        return self.message(command + '=?')
+
+    def passThrough(self, msg):
+        """ask or write like send() does"""
+        return self.send(msg)
+
     def ask(self, *args):
         argList = list(args)
         argList[-1] += '=?'
         _, msg = self.args2message(*argList) # pylint: disable=star-args
         return self.push(msg)
 
+    def queryMany(self, commands):
+        """use the bulk query @ZONE:BASIC=? for all zones we need. The
+        Yamaha sends the values as single lines which go into self.state.
+        The answer to bulkBarrier tells us that the bulk answer is complete.
+        Whatever the bulk query did not deliver is asked for separately."""
+        zones = []
+        for command in commands:
+            zone = command.split(':')[0]
+            if zone in self.bulkZones and zone not in zones:
+                zones.append(zone)
+        if not zones:
+            return Serializer.queryMany(self, commands)
+        before = dict((x, self.state.get(x)) for x in commands)
+        def gotBulk(dummyResult):
+            """now self.state holds all the Yamaha told us"""
+            result = {}
+            missing = []
+            for command in commands:
+                msg = self.state.get(command)
+                if msg is None or msg is before[command]:
+                    missing.append(command)
+                else:
+                    result[command] = msg.value()
+            if not missing:
+                return result
+            def gotMissing(values):
+                """merge the separately asked values"""
+                result.update(values)
+                return result
+            return Serializer.queryMany(self, missing).addCallback(gotMissing)
+        for zone in zones:
+            self.pushBlind('%s:BASIC=?' % zone)
+        return self.ask(self.bulkBarrier).addCallback(gotBulk)
+
     def _poweron(self, *dummyArgs):
         """power on the Yamaha"""
         return self.send('@MAIN:PWR=On')
@@ -180,19 +230,20 @@ class Yamaha(Serializer):
         return self.ask('@MAIN:PWR').addCallback(_volume1, newValue)
 
     def mute(self, dummyResult=None):
-        """toggle between mute/unmuted"""
-        def _mute1(result):
-            """result is ON or STANDBY"""
-            if result.value() != 'On':
+        """toggle between mute/unmuted. With power and volume
+        in the state cache, this is a single write"""
+        oldMutedVolume = self.mutedVolume
+        def _mute1(power, volume=None):
+            """power is On or Standby, volume is the volume before muting"""
+            if not power or power.value() != 'On':
                 return succeed(None)
             if self.mutedVolume:
                 newMV = self.mutedVolume
                 self.mutedVolume = None
                 return self.pushBlind('@MAIN:VOL=%s' % newMV)
-            return self.ask('@MAIN:VOL').addCallback(_mute2)
-        def _mute2(result):
-            """result is the volume before unmuting"""
-            self.mutedVolume = float(result.value())
+            if not volume:
+                return self.ask('@MAIN:VOL').addCallback(lambda x: _mute1(power, x))
+            self.mutedVolume = float(volume.value())
             if self.mutedVolume < -50.1:
                 # denon was muted when halirc started
                 self.mutedVolume = None
@@ -200,4 +251,10 @@ class Yamaha(Serializer):
             else:
                 newMV = -55.0
             return self.pushBlind('@MAIN:VOL=%.1f' % newMV)
-        return self.ask('@MAIN:PWR').addCallback(_mute1)
+        def rollback():
+            """the Yamaha did not do what we predicted"""
+            self.mutedVolume = oldMutedVolume
+        questions = ('@MAIN:PWR', )
+        if not self.mutedVolume and self.predict('@MAIN:VOL'):
+            questions += ('@MAIN:VOL', )
+        return self.speculate(questions, _mute1, verify=('@MAIN:PWR', ), rollback=rollback)